@@ -0,0 +1,284 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+from study_core import estimate_tokens
+
+# AI providers behind one small interface, so app.py isn't tied to the Groq client.
+# complete() returns the answer text, or - with stream=True - an iterator of text
+# deltas (with close()). Streams are opened eagerly so connection and rate-limit
+# errors surface from complete() itself, where the retry policy can see them.
+#
+# RecordingProvider captures real completions to a JSONL file; ReplayProvider
+# serves them back with optional latency / token-rate simulation, which lets us
+# measure the app's own overhead and run throughput experiments offline.
+
+
+def request_key(model, messages, params):
+    """Stable hash of everything that determines a completion"""
+    payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _prompt_preview(messages, limit=200):
+    """Last user text of a request, for browsing a recording file"""
+    for message in reversed(messages):
+        if message.get("role") != "user":
+            continue
+        content = message.get("content")
+        if isinstance(content, list):
+            content = " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+        return (content or "")[:limit]
+    return ""
+
+
+class AIProvider:
+    """Chat-completion provider interface"""
+
+    name = None
+
+    def complete(self, model, messages, max_tokens=None, temperature=None, stream=False,
+                 json_mode=False, timeout=None):
+        """Answer text, or an iterator of text deltas when stream=True"""
+        raise NotImplementedError
+
+    def health_check(self, timeout=None):
+        """Raise if the provider is unreachable"""
+
+
+# ==================== GROQ ====================
+
+class GroqProvider(AIProvider):
+    """Groq chat completions - retries are left to the caller's policy"""
+
+    name = "groq"
+
+    def __init__(self, client):
+        self.client = client
+
+    def complete(self, model, messages, max_tokens=None, temperature=None, stream=False,
+                 json_mode=False, timeout=None):
+        params = {"model": model, "messages": messages, "stream": stream}
+        if max_tokens is not None:
+            params["max_tokens"] = max_tokens
+        if temperature is not None:
+            params["temperature"] = temperature
+        if json_mode:
+            params["response_format"] = {"type": "json_object"}
+
+        options = {"max_retries": 0} if timeout is None else {"max_retries": 0, "timeout": timeout}
+        response = self.client.with_options(**options).chat.completions.create(**params)
+        if stream:
+            return GroqDeltas(response)
+        return response.choices[0].message.content
+
+    def health_check(self, timeout=None):
+        # Cheap, free call against the models list
+        self.client.with_options(max_retries=0, timeout=timeout).models.list()
+
+
+class GroqDeltas:
+    """
+    Text deltas of an open Groq stream. A plain class rather than a generator: close()
+    on a generator that never started skips its finally, leaking the HTTP response
+    (e.g. the losing request of a hedge, which is discarded unread).
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.chunks = iter(response)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            for chunk in self.chunks:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    return delta
+        except Exception:
+            self.close()
+            raise
+        self.close()
+        raise StopIteration
+
+    def close(self):
+        self.response.close()
+
+
+# ==================== RECORD / REPLAY ====================
+
+class RecordingProvider(AIProvider):
+    """Pass calls through to another provider and append each completion to a JSONL recording"""
+
+    name = "record"
+
+    def __init__(self, inner, path):
+        self.inner = inner
+        self.path = path
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def complete(self, model, messages, max_tokens=None, temperature=None, stream=False,
+                 json_mode=False, timeout=None):
+        params = {"max_tokens": max_tokens, "temperature": temperature, "json_mode": json_mode}
+        started = time.time()
+        result = self.inner.complete(model, messages, max_tokens=max_tokens, temperature=temperature,
+                                     stream=stream, json_mode=json_mode, timeout=timeout)
+        if not stream:
+            elapsed = time.time() - started
+            self._save(model, messages, params, result, ttft=elapsed, elapsed=elapsed)
+            return result
+        return RecordedDeltas(result, lambda text, ttft: self._save(
+            model, messages, params, text, ttft=ttft, elapsed=time.time() - started), started)
+
+    def _save(self, model, messages, params, text, ttft, elapsed):
+        generation = max(elapsed - ttft, 0)
+        entry = {
+            "key": request_key(model, messages, params),
+            "model": model,
+            "prompt": _prompt_preview(messages),
+            "json_mode": params["json_mode"],
+            "text": text,
+            "ttft": round(ttft, 4),
+            "tokens_per_second": round(estimate_tokens(text) / generation, 1) if generation > 0 else None,
+            "recorded_at": time.time(),
+        }
+        with self.lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def health_check(self, timeout=None):
+        self.inner.health_check(timeout)
+
+
+class RecordedDeltas:
+    """Pass a stream's deltas through, saving the full text once it ends; close() closes the inner stream"""
+
+    def __init__(self, deltas, save, started):
+        self.deltas = deltas
+        self.chunks = iter(deltas)
+        self.save = save
+        self.started = started
+        self.parts = []
+        self.ttft = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            delta = next(self.chunks)
+        except StopIteration:
+            # Only complete streams are worth replaying
+            if self.save:
+                self.save("".join(self.parts), self.ttft or 0)
+                self.save = None
+            raise
+        if self.ttft is None:
+            self.ttft = time.time() - self.started
+        self.parts.append(delta)
+        return delta
+
+    def close(self):
+        if hasattr(self.deltas, "close"):
+            self.deltas.close()
+
+
+class ReplayMiss(LookupError):
+    """Strict replay found no recording for a request"""
+
+
+class ReplayProvider(AIProvider):
+    """
+    Serve completions from a recording made by RecordingProvider - no network.
+    Exact request matches are served first; otherwise (unless strict) recordings for the
+    same model and output mode (JSON or text), then the same model, then any recording,
+    are served round-robin.
+    simulate_latency sleeps for the recorded time-to-first-token and token rate;
+    ttft / tokens_per_second override the recorded values.
+    """
+
+    name = "replay"
+
+    def __init__(self, path, strict=False, simulate_latency=False, ttft=None, tokens_per_second=None):
+        self.path = path
+        self.strict = strict
+        self.simulate_latency = simulate_latency
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.lock = threading.Lock()
+        self.by_key = {}
+        self.by_kind = {}
+        self.by_model = {}
+        self.entries = []
+        self.cursors = {}
+        self.stats = {"exact": 0, "fallback": 0, "miss": 0}
+
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                self.by_key.setdefault(entry["key"], []).append(entry)
+                self.by_kind.setdefault((entry["model"], entry.get("json_mode", False)), []).append(entry)
+                self.by_model.setdefault(entry["model"], []).append(entry)
+                self.entries.append(entry)
+
+    def _next(self, name, candidates):
+        """Round-robin through candidates so repeated requests get varied answers"""
+        index = self.cursors.get(name, 0)
+        self.cursors[name] = index + 1
+        return candidates[index % len(candidates)]
+
+    def _lookup(self, model, messages, params):
+        key = request_key(model, messages, params)
+        with self.lock:
+            if key in self.by_key:
+                self.stats["exact"] += 1
+                return self._next(key, self.by_key[key])
+            if not self.strict and self.entries:
+                self.stats["fallback"] += 1
+                kind = (model, params["json_mode"])
+                if kind in self.by_kind:
+                    return self._next(kind, self.by_kind[kind])
+                if model in self.by_model:
+                    return self._next(model, self.by_model[model])
+                return self._next("*", self.entries)
+            self.stats["miss"] += 1
+        raise ReplayMiss(f"No recorded completion for {model} (key {key[:12]})")
+
+    def _timing(self, entry):
+        """(seconds before the first token, tokens per second) - zero / None when not simulating"""
+        if not self.simulate_latency:
+            return 0, None
+        ttft = self.ttft if self.ttft is not None else entry.get("ttft") or 0
+        rate = self.tokens_per_second if self.tokens_per_second is not None else entry.get("tokens_per_second")
+        return ttft, rate
+
+    def complete(self, model, messages, max_tokens=None, temperature=None, stream=False,
+                 json_mode=False, timeout=None):
+        params = {"max_tokens": max_tokens, "temperature": temperature, "json_mode": json_mode}
+        entry = self._lookup(model, messages, params)
+        ttft, rate = self._timing(entry)
+        text = entry["text"]
+        # Like a real stream, complete() returns once the first token is due
+        time.sleep(ttft)
+        if stream:
+            return self._stream(text, rate)
+
+        time.sleep(estimate_tokens(text) / rate if rate else 0)
+        return text
+
+    @staticmethod
+    def _stream(text, rate):
+        for piece in re.findall(r"\S+\s*|\s+", text):
+            if rate:
+                time.sleep(estimate_tokens(piece) / rate)
+            yield piece
@@ -1,14 +1,29 @@
 import streamlit as st
-from groq import Groq
+from groq import Groq, APIConnectionError, APITimeoutError, InternalServerError, NotFoundError, RateLimitError
 from supabase import create_client, Client
+from storage import SupabaseRepository, SQLiteRepository
+from ai_providers import GroqProvider, RecordingProvider, ReplayProvider
+from study_core import (
+    validate_email, validate_username, MEMORY_TOKEN_BUDGET, memory_window_start, assemble_ai_messages,
+    preprocess_image, validate_test_question, extract_json_items, extract_test_json, parse_test_questions,
+    flashcards_to_csv
+)
 from datetime import datetime, timedelta, time as dt_time
 import time
-import base64
 import io
 import json
 import re
-from PIL import Image
 import hashlib
+import os
+import sqlite3
+import threading
+import queue
+import atexit
+import random
+import logging
+import bisect
+import hmac
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 
 # ==================== CORE SETUP ====================
 
@@ -80,48 +95,297 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# ==================== LATENCY METRICS ====================
+
+# Every AI attempt and storage round trip is timed into a histogram keyed by
+# (kind, feature, model or operation, outcome). Streamed answers are timed until the stream opens.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # Seconds
+METRICS_EXPORT_PATH = ".study_cache/metrics.prom"  # Prometheus text format (node_exporter textfile collector)
+METRICS_EXPORT_INTERVAL = 15  # Seconds between rewrites of the export file
+METRIC_FAMILIES = {  # kind -> (metric name, target label, help text)
+    "ai": ("study_ai_ai_request_duration_seconds", "model", "Latency of each AI completion attempt"),
+    "db": ("study_ai_db_request_duration_seconds", "operation", "Latency of each storage round trip"),
+}
+PAGE_FEATURES = {
+    "🏠 Home": "home",
+    "💬 Chat": "chat",
+    "📝 Quiz Generator": "quiz",
+    "👨‍🏫 Teacher Mode": "teacher",
+    "📅 Schedule Planner": "schedule",
+    "📸 Image Analysis": "image",
+    "🗂️ Flashcards": "flashcards",
+    "📓 Study Notes": "notes",
+    "⏱️ Study Timer": "timer",
+    "📊 Dashboard": "dashboard",
+    "⚙️ Settings": "settings",
+}
+
+@st.cache_resource
+def get_latency_metrics():
+    """Process-wide latency histograms, rewritten to METRICS_EXPORT_PATH in the background"""
+    metrics = {"lock": threading.Lock(), "series": {}, "since": time.time()}
+    threading.Thread(target=_metrics_exporter, args=(metrics,), daemon=True, name="metrics-export").start()
+    atexit.register(write_metrics_file, metrics)
+    return metrics
+
+def set_rerun_feature(feature):
+    """Tag the rest of this script run's storage calls with a feature"""
+    _rerun_locals().feature = feature
+
+def current_feature():
+    """Feature of the running script, or "background" on worker threads"""
+    return getattr(_rerun_locals(), "feature", None) or "background"
+
+def call_outcome(e):
+    """Low-cardinality outcome label for a failed call"""
+    if isinstance(e, RateLimitError) or getattr(e, "status_code", 0) == 429:
+        return "rate_limited"
+    if isinstance(e, (APITimeoutError, TimeoutError)):
+        return "timeout"
+    return "error"
+
+def observe_latency(kind, feature, target, outcome, seconds):
+    """Add one observation to its histogram"""
+    metrics = get_latency_metrics()
+    key = (kind, feature, target, outcome)
+    with metrics["lock"]:
+        series = metrics["series"].get(key)
+        if series is None:
+            series = metrics["series"][key] = {"buckets": [0] * (len(LATENCY_BUCKETS) + 1), "count": 0,
+                                               "sum": 0.0, "max": 0.0}
+        series["buckets"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        series["count"] += 1
+        series["sum"] += seconds
+        series["max"] = max(series["max"], seconds)
+
+def timed_call(kind, feature, target, run):
+    """Run run(), recording how long it took and whether it succeeded"""
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        return run()
+    except Exception as e:
+        outcome = call_outcome(e)
+        raise
+    finally:
+        observe_latency(kind, feature, target, outcome, time.perf_counter() - started)
+
+def latency_quantile(buckets, q, observed_max):
+    """Estimate a quantile from bucket counts, interpolating inside the bucket (like histogram_quantile)"""
+    total = sum(buckets)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(buckets):
+        if count and seen + count >= rank:
+            lower = LATENCY_BUCKETS[i - 1] if i else 0.0
+            upper = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else observed_max
+            return min(lower + (upper - lower) * (rank - seen) / count, observed_max)
+        seen += count
+    return observed_max
+
+def latency_summary(kind=None):
+    """One row per (kind, feature, target) with counts and p50/p95/p99 over all outcomes"""
+    metrics = get_latency_metrics()
+    grouped = {}
+    with metrics["lock"]:
+        for (series_kind, feature, target, outcome), series in metrics["series"].items():
+            if kind and series_kind != kind:
+                continue
+            row = grouped.setdefault((series_kind, feature, target), {
+                "buckets": [0] * (len(LATENCY_BUCKETS) + 1), "count": 0, "errors": 0, "sum": 0.0, "max": 0.0})
+            row["buckets"] = [a + b for a, b in zip(row["buckets"], series["buckets"])]
+            row["count"] += series["count"]
+            row["sum"] += series["sum"]
+            row["max"] = max(row["max"], series["max"])
+            if outcome != "ok":
+                row["errors"] += series["count"]
+
+    rows = []
+    for (series_kind, feature, target), row in grouped.items():
+        rows.append({
+            "kind": series_kind,
+            "feature": feature,
+            "target": target,
+            "calls": row["count"],
+            "errors": row["errors"],
+            "mean_ms": row["sum"] / row["count"] * 1000,
+            "p50_ms": latency_quantile(row["buckets"], 0.50, row["max"]) * 1000,
+            "p95_ms": latency_quantile(row["buckets"], 0.95, row["max"]) * 1000,
+            "p99_ms": latency_quantile(row["buckets"], 0.99, row["max"]) * 1000,
+            "max_ms": row["max"] * 1000,
+        })
+    return sorted(rows, key=lambda r: r["p99_ms"], reverse=True)
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def metrics_text(metrics=None):
+    """All histograms in the Prometheus text exposition format"""
+    metrics = metrics or get_latency_metrics()
+    with metrics["lock"]:
+        snapshot = {key: dict(series, buckets=list(series["buckets"])) for key, series in metrics["series"].items()}
+
+    lines = []
+    for kind, (name, target_label, help_text) in METRIC_FAMILIES.items():
+        lines.append(f"# HELP {name} {help_text}.")
+        lines.append(f"# TYPE {name} histogram")
+        for (series_kind, feature, target, outcome), series in sorted(snapshot.items()):
+            if series_kind != kind:
+                continue
+            labels = (f'feature="{_label_value(feature)}",{target_label}="{_label_value(target)}",'
+                      f'outcome="{_label_value(outcome)}"')
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), series["buckets"]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{labels}}} {series['sum']:.6f}")
+            lines.append(f"{name}_count{{{labels}}} {series['count']}")
+    return "\n".join(lines) + "\n"
+
+def write_metrics_file(metrics=None):
+    """Atomically rewrite the export file so a scraper never reads half of it"""
+    try:
+        os.makedirs(os.path.dirname(METRICS_EXPORT_PATH), exist_ok=True)
+        tmp_path = METRICS_EXPORT_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(metrics_text(metrics))
+        os.replace(tmp_path, METRICS_EXPORT_PATH)
+        return True
+    except OSError:
+        return False
+
+def _metrics_exporter(metrics):
+    """Rewrite the export file forever"""
+    while True:
+        time.sleep(METRICS_EXPORT_INTERVAL)
+        write_metrics_file(metrics)
+
+def reset_latency_metrics():
+    """Start the histograms over"""
+    metrics = get_latency_metrics()
+    with metrics["lock"]:
+        metrics["series"].clear()
+        metrics["since"] = time.time()
+
 # ==================== API INITIALIZATION ====================
 
+LOCAL_DB_PATH = ".study_cache/study.sqlite3"  # Default file for storage.backend = "sqlite"
+
 @st.cache_resource
-def initialize_supabase():
-    """Initialize Supabase client with error handling"""
+def _rerun_locals():
+    """Per-thread state of the running script (one object shared by every rerun's module copy)"""
+    return threading.local()
+
+def count_external_call(kind):
+    """Count a database round trip ("round_trips") or AI request ("ai_calls") against the current script run"""
+    stats = getattr(_rerun_locals(), "stats", None)
+    if stats is not None:
+        stats[kind] += 1
+
+def db_execute(run, name):
+    """Perform one storage round trip, counting it against the current script run and timing it"""
+    count_external_call("round_trips")
+    return timed_call("db", current_feature(), name, run)
+
+@st.cache_resource
+def initialize_storage():
+    """
+    Pick the storage backend: Supabase, or a local SQLite database only when explicitly
+    requested (storage.backend in secrets or STUDY_STORAGE_BACKEND) - a missing Supabase
+    secret must stay a configuration error, not a silent switch to an empty local user base
+    """
     try:
-        url = st.secrets["supabase"]["url"]
-        key = st.secrets["supabase"]["key"]
-        client = create_client(url, key)
-        return client, None
+        settings = dict(st.secrets.get("storage", {}))
+    except Exception:
+        settings = {}  # No secrets file at all
+    
+    backend = settings.get("backend") or os.environ.get("STUDY_STORAGE_BACKEND", "supabase")
+    try:
+        if backend == "sqlite":
+            return SQLiteRepository(settings.get("path", LOCAL_DB_PATH), execute=db_execute), None
+        if backend != "supabase":
+            return None, f"Unknown storage backend '{backend}' (use \"supabase\" or \"sqlite\")"
+        if "supabase" not in st.secrets:
+            return None, "Supabase is not configured - add [supabase] url and key to Streamlit Secrets"
+        client = create_client(st.secrets["supabase"]["url"], st.secrets["supabase"]["key"])
+        return SupabaseRepository(client, execute=db_execute), None
     except Exception as e:
         return None, str(e)
 
+AI_RECORDING_PATH = ".study_cache/ai_recording.jsonl"  # Written by provider = "record", read by "replay"
+
 @st.cache_resource
-def initialize_groq():
-    """Initialize Groq client with error handling"""
+def initialize_ai_provider():
+    """
+    Build the AI provider from the [ai] secrets (no network - see get_ai_health):
+    "groq" (default), "record" (Groq, saving every completion) or "replay" (recorded answers, offline)
+    """
     try:
-        api_key = st.secrets["GROQ_API_KEY"]
-        client = Groq(api_key=api_key)
-        # Test connection
-        client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=[{"role": "user", "content": "test"}],
-            max_tokens=5
-        )
-        return client, None
+        settings = dict(st.secrets.get("ai", {}))
+    except Exception:
+        settings = {}  # No secrets file at all
+    
+    mode = settings.get("provider", "groq")
+    recording = settings.get("recording", AI_RECORDING_PATH)
+    try:
+        if mode == "replay":
+            return ReplayProvider(
+                recording,
+                strict=settings.get("strict", False),
+                simulate_latency=settings.get("simulate_latency", False),
+                ttft=settings.get("ttft"),
+                tokens_per_second=settings.get("tokens_per_second")
+            ), None
+        provider = GroqProvider(Groq(api_key=st.secrets["GROQ_API_KEY"]))
+        if mode == "record":
+            provider = RecordingProvider(provider, recording)
+        return provider, None
     except Exception as e:
         return None, str(e)
 
+AI_HEALTH_TTL = 300  # Seconds before the background health probe is repeated
+AI_HEALTH_TIMEOUT = 5
+
+@st.cache_resource
+def _ai_health_state():
+    """Shared result of the last AI provider health probe"""
+    return {"status": "unknown", "detail": "", "checked_at": 0, "probing": False, "lock": threading.Lock()}
+
+def _probe_ai(state):
+    """Cheap, free health check (runs in a background thread)"""
+    try:
+        ai_provider.health_check(timeout=AI_HEALTH_TIMEOUT)
+        status, detail = "ok", ""
+    except Exception as e:
+        status, detail = "error", str(e)
+    with state["lock"]:
+        state.update(status=status, detail=detail, checked_at=time.time(), probing=False)
+
+def get_ai_health():
+    """Return the latest probe result, starting a new probe off the script thread when stale"""
+    state = _ai_health_state()
+    with state["lock"]:
+        stale = time.time() - state["checked_at"] > AI_HEALTH_TTL
+        if ai_provider and stale and not state["probing"]:
+            state["probing"] = True
+            threading.Thread(target=_probe_ai, args=(state,), daemon=True, name="ai-health").start()
+        return {"status": state["status"], "detail": state["detail"]}
+
 # Initialize clients
-supabase, supabase_error = initialize_supabase()
-groq_client, groq_error = initialize_groq()
+db, db_error = initialize_storage()
+ai_provider, ai_error = initialize_ai_provider()
 
 # Display initialization errors if any
-if supabase_error:
-    st.error(f"⚠️ Supabase Error: {supabase_error}")
-    st.info("Add Supabase credentials to Streamlit Secrets")
+if db_error:
+    st.error(f"⚠️ Storage Error: {db_error}")
+    st.info("Check the Supabase credentials in Streamlit Secrets, or set storage.backend = \"sqlite\" to run locally")
     st.stop()
 
-if groq_error:
-    st.error(f"⚠️ Groq Error: {groq_error}")
-    st.info("Add GROQ_API_KEY to Streamlit Secrets")
+if ai_error:
+    st.error(f"⚠️ AI Provider Error: {ai_error}")
+    st.info("Add GROQ_API_KEY to Streamlit Secrets, or set ai.provider = \"replay\" to serve recorded answers")
     st.stop()
 
 # ==================== SESSION STATE INITIALIZATION ====================
@@ -134,6 +398,12 @@ def init_session_state():
         'user_data': {},
         'selected_menu': "🏠 Home",  # Track menu selection
         'chat_messages': [],
+        'chat_summary': "",  # Rolling summary of turns older than the memory window
+        'chat_summary_upto': 0,  # Number of chat_messages covered by chat_summary
+        'chat_summary_job': None,  # Summary being written in the background
+        'chat_oldest': None,  # Oldest history row loaded - keyset cursor for "load older"
+        'chat_has_older': False,
+        'chat_render_window': None,  # Messages rendered per rerun (None = CHAT_RENDER_WINDOW)
         'test_active': False,
         'test_questions': [],
         'test_answers': {},
@@ -146,8 +416,14 @@ def init_session_state():
         'study_timer_start': None,
         'total_study_time': 0,
         'notes': [],
+        'notes_list': None,  # Paginated note metadata - see get_notes_list()
+        'note_content_cache': {},  # note id -> content, fetched on demand
+        'shared_reads': {},  # DataLoader results re-used across reruns and pages
+        'last_rerun_stats': None,  # Round trips made by the previous script run
+        'rerun_totals': {"runs": 0, "round_trips": 0, "ai_calls": 0, "elapsed": 0.0},  # Cumulative, for load tests
         'bookmarks': [],
         'dark_mode': False,
+        'profile_cache': None,  # {'user_id', 'data', 'fetched_at'} - see load_profile()
     }
     
     for key, value in defaults.items():
@@ -162,54 +438,148 @@ def hash_password(password):
     """Hash password for security"""
     return hashlib.sha256(password.encode()).hexdigest()
 
-def validate_email(email):
-    """Validate email format"""
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+FREE_DAILY_LIMIT = 100
+PREMIUM_DAILY_LIMIT = 1000
+USAGE_WINDOW_HOURS = 24
+USAGE_RECONCILE_INTERVAL = 600  # Seconds between reconciling the counter against Supabase
 
-def validate_username(username):
-    """Validate username format"""
-    return bool(re.match(r'^[\w\-]{3,20}$', username, re.UNICODE))
+@st.cache_resource
+def get_usage_counters():
+    """Process-wide sliding-window usage counters, one ring of hourly buckets per user"""
+    return {"lock": threading.Lock(), "users": {}}
+
+def _usage_ring(key):
+    """Get (or create) the hourly ring buffer for a usage key - caller holds the lock"""
+    users = get_usage_counters()["users"]
+    if key not in users:
+        users[key] = {
+            "counts": [0] * USAGE_WINDOW_HOURS,
+            "hours": [-1] * USAGE_WINDOW_HOURS,  # Absolute hour each slot currently holds
+            "reconciled_at": 0,
+        }
+    return users[key]
+
+def _ring_add(ring, hour, amount=1):
+    """Add to the bucket for an absolute hour, recycling the slot if it is stale"""
+    slot = hour % USAGE_WINDOW_HOURS
+    if ring["hours"][slot] != hour:
+        ring["hours"][slot] = hour
+        ring["counts"][slot] = 0
+    ring["counts"][slot] += amount
+
+def _ring_total(ring, hour):
+    """Sum the buckets that fall inside the window ending at the given hour"""
+    return sum(
+        count for count, h in zip(ring["counts"], ring["hours"])
+        if hour - USAGE_WINDOW_HOURS < h <= hour
+    )
+
+def usage_key():
+    """Counter key for the current session - user id, or a per-session id for guests"""
+    if st.session_state.get('is_guest', False) or not st.session_state.user:
+        if 'guest_usage_key' not in st.session_state:
+            st.session_state.guest_usage_key = f"guest-{os.urandom(8).hex()}"
+        return st.session_state.guest_usage_key
+    return st.session_state.user.id
+
+def record_usage(amount=1, key=None):
+    """Count usage in the current hour's bucket - pass key from worker threads, which have no session"""
+    counters = get_usage_counters()
+    with counters["lock"]:
+        _ring_add(_usage_ring(key or usage_key()), int(time.time() // 3600), amount)
+
+def reconcile_usage():
+    """Rebuild the current user's buckets from their history rows of the last 24 hours"""
+    time_threshold = (datetime.now() - timedelta(hours=USAGE_WINDOW_HOURS)).isoformat()
+    rows = db.history_since(st.session_state.user.id, time_threshold)
+    
+    counts = [0] * USAGE_WINDOW_HOURS
+    hours = [-1] * USAGE_WINDOW_HOURS
+    ring = {"counts": counts, "hours": hours}
+    for row in rows:
+        try:
+            created = datetime.fromisoformat(row["created_at"]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            continue
+        _ring_add(ring, int(created // 3600))
+    
+    counters = get_usage_counters()
+    with counters["lock"]:
+        stored = _usage_ring(st.session_state.user.id)
+        # Keep the larger count per hour: history misses rows still in the write-behind
+        # queue and AI calls that save no history (quiz, images, ...)
+        for slot in range(USAGE_WINDOW_HOURS):
+            if stored["hours"][slot] == hours[slot]:
+                counts[slot] = max(counts[slot], stored["counts"][slot])
+            elif stored["hours"][slot] > hours[slot]:
+                counts[slot], hours[slot] = stored["counts"][slot], stored["hours"][slot]
+        stored["counts"], stored["hours"] = counts, hours
+        stored["reconciled_at"] = time.time()
 
 def get_daily_usage():
-    """Get user's daily API usage"""
+    """Get user's usage over the last 24 hours from the in-process sliding window"""
     if st.session_state.last_reset != datetime.now().date():
         st.session_state.api_calls_today = 0
         st.session_state.last_reset = datetime.now().date()
     
-    if not supabase or not st.session_state.user:
-        return st.session_state.api_calls_today
-    
-    try:
-        time_threshold = (datetime.now() - timedelta(hours=24)).isoformat()
-        res = supabase.table("history").select("id", count="exact").eq(
-            "user_id", st.session_state.user.id
-        ).gte("created_at", time_threshold).execute()
-        return res.count if res.count else 0
-    except:
-        return st.session_state.api_calls_today
+    is_guest = st.session_state.get('is_guest', False)
+    if db and st.session_state.user and not is_guest:
+        counters = get_usage_counters()
+        with counters["lock"]:
+            reconciled_at = _usage_ring(usage_key())["reconciled_at"]
+        if time.time() - reconciled_at > USAGE_RECONCILE_INTERVAL:
+            try:
+                reconcile_usage()
+            except:
+                pass  # Keep serving the local count until the next attempt
+    
+    counters = get_usage_counters()
+    with counters["lock"]:
+        return _ring_total(_usage_ring(usage_key()), int(time.time() // 3600))
+
+def get_usage_limit():
+    """Daily usage limit for the current user's plan"""
+    is_premium = st.session_state.user_data.get('is_premium', False)
+    return PREMIUM_DAILY_LIMIT if is_premium else FREE_DAILY_LIMIT
+
+def check_usage_limit(needed=1):
+    """Return an error string if today's limit can't cover `needed` more AI calls, else None"""
+    usage = get_daily_usage()
+    limit = get_usage_limit()
+    if usage >= limit:
+        return f"⚠️ Daily limit reached ({usage}/{limit}). Upgrade to Premium or come back later!"
+    if usage + needed > limit:
+        return (f"⚠️ This needs {needed} AI calls but only {limit - usage} are left today ({usage}/{limit}). "
+                f"Try fewer at once or upgrade to Premium!")
+    return None
 
 def increment_usage():
     """Increment daily API call counter"""
     st.session_state.api_calls_today += 1
+    # Logged-in usage is counted from history writes in save_chat_message
+    if st.session_state.get('is_guest', False):
+        record_usage()
+
+def chat_turn_usage():
+    """Usage one chat turn costs - both history rows for logged-in users, the single call for guests"""
+    return 1 if st.session_state.get('is_guest', False) else 2
 
 def award_xp(amount, reason=""):
-    """Award XP to user and update profile"""
-    if not supabase or not st.session_state.user:
+    """Award XP via the XP ledger - the profile write is coalesced and sent in the background"""
+    if not db or not st.session_state.user:
         return False
     
     try:
-        current_xp = st.session_state.user_data.get('xp', 0)
-        new_xp = current_xp + amount
-        
-        supabase.table("profiles").update({
-            "xp": new_xp
-        }).eq("id", st.session_state.user.id).execute()
+        user_id = st.session_state.user.id
+        old_xp, new_xp = xp_ledger_append(user_id, amount, reason,
+                                          seed=st.session_state.user_data.get('xp', 0))
+        enqueue_xp_flush(user_id)
         
+        # user_data is the cached profile itself, so it stays current without a re-fetch
         st.session_state.user_data['xp'] = new_xp
         
-        # Check for level up
-        old_level = current_xp // 100 + 1
+        # Check for level up on the folded total
+        old_level = old_xp // 100 + 1
         new_level = new_xp // 100 + 1
         
         if new_level > old_level:
@@ -240,79 +610,360 @@ def check_achievement(achievement_type):
 
 # ==================== AI HELPER FUNCTIONS ====================
 
-def safe_ai_call(prompt, system_role="Expert Study Assistant", include_memory=True, model="llama-3.3-70b-versatile"):
+AI_MAX_TOKENS = 2000
+AI_TEMPERATURE = 0.7
+
+SUMMARY_MAX_TOKENS = 300
+SUMMARY_MODEL = "llama-3.1-8b-instant"
+
+def conversation_memory(prompt=None):
+    """Chat history to draw memory from, minus the prompt about to be appended to it"""
+    history = st.session_state.chat_messages
+    if prompt is not None and history and history[-1] == {"role": "user", "content": prompt}:
+        history = history[:-1]
+    return history
+
+def build_ai_messages(prompt, system_role="Expert Study Assistant", include_memory=True):
+    """Build the message list sent to the model from the session's chat memory"""
+    if not include_memory or not st.session_state.chat_messages:
+        return assemble_ai_messages(prompt, system_role)
+    
+    apply_chat_summary()
+    history = conversation_memory(prompt)
+    return assemble_ai_messages(
+        prompt, system_role, history,
+        summary=st.session_state.chat_summary,
+        summarized_upto=min(st.session_state.chat_summary_upto, len(history))
+    )
+
+def update_chat_summary():
+    """
+    Fold turns that no longer fit the memory budget into the rolling summary, in the background.
+    Evicts down to half the budget so the (cheap) summary call runs every few turns, not every turn.
+    """
+    apply_chat_summary()
+    if st.session_state.chat_summary_job or not ai_provider:
+        return  # One summary at a time - the next turn picks up whatever is left
+    
+    history = st.session_state.chat_messages
+    summarized_upto = min(st.session_state.chat_summary_upto, len(history))
+    
+    if memory_window_start(history, floor=summarized_upto) == summarized_upto:
+        return
+    
+    new_upto = memory_window_start(history, budget=MEMORY_TOKEN_BUDGET // 2, floor=summarized_upto)
+    turns = "\n".join(f"{msg['role'].title()}: {msg['content']}" for msg in history[summarized_upto:new_upto])
+    future = get_prefetch_executor().submit(summarize_turns, st.session_state.chat_summary, turns)
+    st.session_state.chat_summary_job = {"future": future, "upto": new_upto}
+
+def summarize_turns(summary, turns):
+    """Updated rolling summary - touches no Streamlit state, so it runs on a worker thread"""
+    return timed_call("ai", "chat", SUMMARY_MODEL, lambda: ai_provider.complete(
+        SUMMARY_MODEL,
+        [
+            {"role": "system", "content": "You maintain a concise running summary of a study conversation. "
+                                          "Keep topics, facts the student learned, and open questions."},
+            {"role": "user", "content": f"Current summary:\n{summary or '(none)'}"
+                                        f"\n\nNew turns:\n{turns}\n\nReturn the updated summary only."}
+        ],
+        max_tokens=SUMMARY_MAX_TOKENS,
+        temperature=0.3
+    ))
+
+def apply_chat_summary():
+    """Adopt a finished background summary (never waits for one still running)"""
+    job = st.session_state.chat_summary_job
+    if not job or not job["future"].done():
+        return
+    st.session_state.chat_summary_job = None
+    try:
+        st.session_state.chat_summary = job["future"].result()
+        st.session_state.chat_summary_upto = job["upto"]
+    except Exception:
+        pass  # Older turns just drop out of the window until the next attempt
+
+def reset_chat_summary():
+    """Forget the rolling summary (chat cleared, reloaded or user changed) and any summary in flight"""
+    st.session_state.chat_summary = ""
+    st.session_state.chat_summary_upto = 0
+    st.session_state.chat_summary_job = None
+
+# Retry policy
+AI_RETRY_ATTEMPTS = 3  # Attempts per model before falling back to the next one
+AI_BACKOFF_BASE = 0.5  # Seconds, doubled per attempt (full jitter)
+AI_BACKOFF_MAX = 8
+AI_FEATURE_DEADLINES = {  # Total seconds a feature may spend on one AI request, retries included
+    "chat": 30,
+    "quiz": 45,
+    "teacher": 45,
+    "flashcards": 60,
+    "schedule": 60,
+    "notes": 45,
+    "image": 60,
+}
+AI_DEFAULT_DEADLINE = 45
+AI_MODEL_FALLBACKS = {  # Tried in order once a model keeps failing
+    "llama-3.3-70b-versatile": ["llama-3.1-8b-instant"],
+    "llama-3.2-90b-vision-preview": ["llama-3.2-11b-vision-preview", "meta-llama/llama-4-scout-17b-16e-instruct"],
+}
+AI_HEDGE_CHAT = True  # Send a backup chat request if the first is slow to answer
+AI_HEDGE_DELAY = 2.0  # Seconds before the backup request is sent
+
+class AIDeadlineExceeded(Exception):
+    """Raised when a feature's AI deadline runs out before any attempt succeeds"""
+
+@st.cache_resource
+def get_hedge_executor():
+    """Thread pool for hedged requests"""
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="ai-hedge")
+
+def _is_retryable(e):
+    """Rate limits, timeouts, connection drops and 5xx are worth retrying"""
+    if isinstance(e, (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)):
+        return True
+    return getattr(e, "status_code", 0) >= 500
+
+def _should_fall_back(e):
+    """Errors after which another model may still succeed"""
+    return _is_retryable(e) or isinstance(e, NotFoundError) or "decommissioned" in str(e).lower()
+
+def _retry_after(e):
+    """Seconds the server asked us to wait, from retry-after-ms / retry-after"""
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+        try:
+            return float(response.headers.get(header)) * scale
+        except (TypeError, ValueError):
+            pass
+    return None
+
+def _discard_result(future):
+    """Close the losing stream of a hedged request"""
+    try:
+        result = future.result()
+        if hasattr(result, "close"):
+            result.close()
+    except Exception:
+        pass
+
+def _hedged(request, model, timeout):
+    """Run request, and a duplicate if the first hasn't answered within AI_HEDGE_DELAY; first success wins"""
+    executor = get_hedge_executor()
+    primary = executor.submit(request, model, timeout)
+    done, _ = wait([primary], timeout=AI_HEDGE_DELAY)
+    if done:
+        return primary.result()
+    
+    futures = [primary, executor.submit(request, model, timeout)]
+    error = None
+    for future in as_completed(futures):
+        try:
+            result = future.result()
+        except Exception as e:
+            error = e
+            continue
+        for other in futures:
+            if other is not future:
+                other.add_done_callback(_discard_result)
+        return result
+    raise error
+
+def resilient_request(request, model, feature=None, hedge=False):
+    """
+    Run request(model, timeout) with exponential backoff + jitter (honoring retry-after),
+    a per-feature deadline and the model fallback chain. Returns the request's result.
+    """
+    deadline = time.time() + AI_FEATURE_DEADLINES.get(feature, AI_DEFAULT_DEADLINE)
+    last_error = None
+    
+    # Each attempt (hedged duplicates included) is its own latency span
+    span_feature = feature or current_feature()
+    untimed = request
+    request = lambda model, timeout: timed_call("ai", span_feature, model, lambda: untimed(model, timeout))
+    
+    for candidate in [model] + AI_MODEL_FALLBACKS.get(model, []):
+        for attempt in range(AI_RETRY_ATTEMPTS):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise AIDeadlineExceeded(f"No answer within {AI_FEATURE_DEADLINES.get(feature, AI_DEFAULT_DEADLINE)}s") from last_error
+            
+            # Providers don't retry on their own - this policy owns retries
+            count_external_call("ai_calls")
+            try:
+                if hedge:
+                    return _hedged(request, candidate, remaining)
+                return request(candidate, remaining)
+            except Exception as e:
+                last_error = e
+                if not _is_retryable(e):
+                    break
+                
+                delay = _retry_after(e)
+                if delay is None:
+                    delay = random.uniform(0, min(AI_BACKOFF_MAX, AI_BACKOFF_BASE * 2 ** attempt))
+                if attempt == AI_RETRY_ATTEMPTS - 1 or time.time() + delay >= deadline:
+                    break  # Another model has its own rate limits - try it right away
+                time.sleep(delay)
+        
+        if not _should_fall_back(last_error):
+            break
+    
+    raise last_error
+
+def format_ai_error(e):
+    """Turn a provider exception into a user-facing error string"""
+    if isinstance(e, AIDeadlineExceeded):
+        return "⏱️ The AI is taking too long right now. Please try again in a moment."
+    error_str = str(e)
+    if "rate_limit" in error_str.lower() or "429" in error_str:
+        return "⚠️ Rate limit reached. Please wait a moment and try again."
+    return f"Error: {error_str}"
+
+def safe_ai_call(prompt, system_role="Expert Study Assistant", include_memory=True, model="llama-3.3-70b-versatile", feature=None, json_mode=False):
     """
     Safe AI call with error handling and retry logic
+    json_mode asks the model for a JSON object (the prompt must mention JSON)
     """
-    if not groq_client:
+    if not ai_provider:
         return None, "AI client not initialized"
     
+    limit_error = check_usage_limit()
+    if limit_error:
+        return None, limit_error
+    
     try:
-        messages = []
-        
-        # Add memory if requested
-        if include_memory and st.session_state.chat_messages:
-            for msg in st.session_state.chat_messages[-10:]:  # Last 10 messages
-                messages.append({
-                    "role": msg["role"],
-                    "content": msg["content"]
-                })
-        
-        # System message
-        messages.insert(0, {
-            "role": "system",
-            "content": f"{system_role}. Be helpful, clear, and educational."
-        })
-        
-        # Current prompt
-        messages.append({
-            "role": "user",
-            "content": prompt
-        })
-        
-        # Call Groq
-        response = groq_client.chat.completions.create(
-            model=model,
-            messages=messages,
-            max_tokens=2000,
-            temperature=0.7
+        messages = build_ai_messages(prompt, system_role, include_memory)
+    except Exception as e:
+        return None, format_ai_error(e)
+    
+    content, error = complete_ai(messages, model=model, feature=feature, json_mode=json_mode)
+    if content:
+        record_usage()
+    return content, error
+
+def complete_ai(messages, model="llama-3.3-70b-versatile", feature=None, json_mode=False):
+    """
+    Run a completion through the retry policy. Touches no Streamlit state, so background
+    threads can use it (callers are responsible for the usage-limit check). Returns (content, error).
+    """
+    if not ai_provider:
+        return None, "AI client not initialized"
+    
+    try:
+        content = resilient_request(
+            lambda model, timeout: ai_provider.complete(
+                model,
+                messages,
+                max_tokens=AI_MAX_TOKENS,
+                temperature=AI_TEMPERATURE,
+                json_mode=json_mode,
+                timeout=timeout
+            ),
+            model,
+            feature=feature
         )
         
-        return response.choices[0].message.content, None
+        return content, None
         
     except Exception as e:
-        error_str = str(e)
-        if "rate_limit" in error_str.lower() or "429" in error_str:
-            return None, "⚠️ Rate limit reached. Please wait a moment and try again."
-        return None, f"Error: {error_str}"
+        return None, format_ai_error(e)
 
-def analyze_image_with_ai(image_file, prompt):
-    """Analyze image using Groq vision model"""
+def safe_ai_call_stream(prompt, system_role="Expert Study Assistant", include_memory=True, model="llama-3.3-70b-versatile", feature="chat"):
+    """
+    Streaming variant of safe_ai_call.
+    Returns (chunk generator, error) - feed the generator to st.write_stream.
+    """
+    if not ai_provider:
+        return None, "AI client not initialized"
+    
+    limit_error = check_usage_limit()
+    if limit_error:
+        return None, limit_error
+    
     try:
-        # Convert image to base64
-        img = Image.open(image_file)
-        
-        if img.mode in ("RGBA", "P"):
-            img = img.convert("RGB")
-        
-        buffer = io.BytesIO()
-        img.save(buffer, format="JPEG")
-        buffer.seek(0)
-        image_bytes = buffer.read()
-        image_b64 = base64.b64encode(image_bytes).decode("utf-8")
+        messages = build_ai_messages(prompt, system_role, include_memory)
+        
+        # Open the stream up front so connection/rate-limit errors surface (and are retried) here
+        stream = resilient_request(
+            lambda model, timeout: ai_provider.complete(
+                model,
+                messages,
+                max_tokens=AI_MAX_TOKENS,
+                temperature=AI_TEMPERATURE,
+                stream=True,
+                timeout=timeout
+            ),
+            model,
+            feature=feature,
+            hedge=AI_HEDGE_CHAT and feature == "chat"
+        )
+    except Exception as e:
+        return None, format_ai_error(e)
+    
+    def generate():
+        try:
+            for delta in stream:
+                yield delta
+        except Exception:
+            # Keep whatever arrived before the stream broke
+            return
+    
+    return generate(), None
+
+def get_preprocessed_image(image_file):
+    """preprocess_image, memoized per upload so reruns don't decode the file again"""
+    file_id = getattr(image_file, "file_id", None)
+    cached = st.session_state.get('preprocessed_image')
+    if file_id and cached and cached["file_id"] == file_id:
+        return cached["data"]
+    
+    data = preprocess_image(image_file)
+    if file_id:
+        st.session_state.preprocessed_image = {"file_id": file_id, "data": data}
+    return data
+
+def format_bytes_saved(processed):
+    """Caption describing how much the preprocessing shrank the upload"""
+    original, encoded = processed["original_bytes"], processed["encoded_bytes"]
+    saved = max(0, original - encoded)
+    percent = saved / original * 100 if original else 0
+    return f"📦 {original / 1024:,.0f} KB → {encoded / 1024:,.0f} KB ({percent:.0f}% smaller upload)"
+
+def analyze_image_with_ai(image, prompt):
+    """Analyze image using Groq vision model - image is an upload or a preprocess_image() result"""
+    limit_error = check_usage_limit()
+    if limit_error:
+        return None, limit_error
+    
+    try:
+        processed = image if isinstance(image, dict) else get_preprocessed_image(image)
+    except Exception as e:
+        return None, str(e)
+    
+    content, error = vision_completion(processed, prompt)
+    if content:
+        record_usage()
+    return content, error
+
+def vision_completion(processed, prompt):
+    """Send a preprocessed image to the vision model - touches no Streamlit state, so it is safe in worker threads"""
+    try:
+        image_b64 = processed["b64"]
         
-        # Try primary vision model
+        # Primary vision model, falling back along AI_MODEL_FALLBACKS
         try:
-            response = groq_client.chat.completions.create(
-                model="llama-3.2-90b-vision-preview",
-                messages=[
+            content = resilient_request(lambda model, timeout: ai_provider.complete(
+                model,
+                [
                     {
                         "role": "user",
                         "content": [
                             {
                                 "type": "image_url",
                                 "image_url": {
-                                    "url": f"data:image/jpeg;base64,{image_b64}"
+                                    "url": f"data:{processed['mime']};base64,{image_b64}"
                                 }
                             },
                             {
@@ -322,71 +973,1081 @@ def analyze_image_with_ai(image_file, prompt):
                         ]
                     }
                 ],
-                max_tokens=1500
-            )
-            return response.choices[0].message.content, None
-        except:
+                max_tokens=1500,
+                timeout=timeout
+            ), "llama-3.2-90b-vision-preview", feature="image")
+            return content, None
+        except Exception as e:
             # Fallback to text-based description
-            return None, "Vision model unavailable. Please describe the image and I'll help!"
+            return None, f"Vision model unavailable ({format_ai_error(e)}). Please describe the image and I'll help!"
             
     except Exception as e:
         return None, str(e)
 
+IMAGE_BATCH_WORKERS = 6  # Concurrent vision requests across all sessions
+IMAGE_BATCH_MAX_FILES = 20
+
+@st.cache_resource
+def get_image_executor():
+    """Bounded thread pool shared by every batch image analysis"""
+    return ThreadPoolExecutor(max_workers=IMAGE_BATCH_WORKERS, thread_name_prefix="image-batch")
+
+def _analyze_image_bytes(data, prompt):
+    """Worker: preprocess raw upload bytes and run the vision request"""
+    try:
+        processed = preprocess_image(io.BytesIO(data))
+    except Exception as e:
+        return None, None, f"Couldn't read image: {e}"
+    result, error = vision_completion(processed, prompt)
+    return processed, result, error
+
+def analyze_image_batch(files, prompt):
+    """
+    Preprocess and analyze several uploads concurrently.
+    Yields (index, processed, result, error) in completion order.
+    """
+    executor = get_image_executor()
+    futures = {
+        executor.submit(_analyze_image_bytes, uploaded.getvalue(), prompt): idx
+        for idx, uploaded in enumerate(files)
+    }
+    for future in as_completed(futures):
+        processed, result, error = future.result()
+        yield futures[future], processed, result, error
+
+def analyze_image_multi(processed, prompts):
+    """
+    Run several prompts against one preprocessed image concurrently - the image is encoded once.
+    prompts maps label -> prompt; yields (label, result, error) in completion order.
+    """
+    executor = get_image_executor()
+    futures = {executor.submit(vision_completion, processed, prompt): label for label, prompt in prompts.items()}
+    for future in as_completed(futures):
+        result, error = future.result()
+        yield futures[future], result, error
+
+# ==================== TEST GENERATION ====================
+
+TEST_REPAIR_ATTEMPTS = 2  # Follow-up requests for questions that were dropped by validation
+
+def build_test_prompt(subject, topic, difficulty, num_q, avoid=None):
+    """Prompt for a JSON-mode multiple choice test"""
+    prompt = f"""Create a {num_q}-question multiple choice test about {subject} - {topic} ({difficulty}).
+
+Respond with JSON only, in exactly this shape:
+{{"questions": [{{"question": "...", "options": {{"A": "...", "B": "...", "C": "...", "D": "..."}}, "correct": "A"}}]}}
+
+Every question needs exactly four options A-D and one correct letter."""
+    if avoid:
+        prompt += "\n\nDo not repeat any of these questions:\n" + "\n".join(f"- {q}" for q in avoid)
+    return prompt
+
+def generate_test(subject, topic, difficulty, num_q, background=False, cancel=None, count_as=None):
+    """
+    Generate a validated test. Questions dropped by validation are re-requested on their own
+    instead of regenerating the whole test. Returns (questions, error).
+    background=True avoids Streamlit state so it can run in a worker thread; cancel is an optional Event
+    and count_as the usage key its AI calls are counted against.
+    """
+    def ask(prompt):
+        if background:
+            content, error = complete_ai(build_ai_messages(prompt, include_memory=False), feature="teacher", json_mode=True)
+            if content and count_as:
+                record_usage(key=count_as)
+            return content, error
+        return safe_ai_call(prompt, include_memory=False, feature="teacher", json_mode=True)
+    
+    content, error = ask(build_test_prompt(subject, topic, difficulty, num_q))
+    if not content:
+        return None, error
+    
+    questions = []
+    seen = set()
+    
+    def add(candidates):
+        for q in candidates:
+            stem = normalize_prompt(q["question"])
+            if stem not in seen and len(questions) < num_q:
+                seen.add(stem)
+                questions.append(q)
+    
+    add(parse_test_questions(content))
+    
+    for _ in range(TEST_REPAIR_ATTEMPTS):
+        missing = num_q - len(questions)
+        if missing <= 0 or (cancel and cancel.is_set()):
+            break
+        content, error = ask(
+            build_test_prompt(subject, topic, difficulty, missing, avoid=[q["question"] for q in questions])
+        )
+        if not content:
+            break
+        add(parse_test_questions(content))
+    
+    if not questions:
+        return None, error or "Failed to generate test. Try again!"
+    
+    for number, q in enumerate(questions, 1):
+        q["number"] = number
+    return questions, None
+
+TEST_DIFFICULTIES = ["Easy", "Medium", "Hard", "Expert"]
+PREFETCH_STEP_UP_SCORE = 90  # Prefetch one difficulty higher after scoring at least this
+PREFETCH_MIN_REMAINING = 5  # Skip prefetching unless this many calls are left - covers the test plus its repairs
+
+@st.cache_resource
+def get_prefetch_executor():
+    """Small pool for background AI work - test prefetch and chat summaries"""
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="test-prefetch")
+
+def start_test_prefetch(params):
+    """Generate the next test in the background, replacing any prefetch for different params"""
+    current = st.session_state.get('test_prefetch')
+    if current and current["params"] == params and not current["cancel"].is_set():
+        return
+    cancel_test_prefetch()
+    
+    if check_usage_limit(PREFETCH_MIN_REMAINING):
+        return
+    
+    cancel = threading.Event()
+    future = get_prefetch_executor().submit(generate_test, **params, background=True, cancel=cancel,
+                                            count_as=usage_key())
+    st.session_state.test_prefetch = {"params": params, "future": future, "cancel": cancel}
+
+def cancel_test_prefetch():
+    """Drop the pending prefetch - a request already in flight finishes but its result is discarded"""
+    current = st.session_state.get('test_prefetch')
+    if current:
+        current["cancel"].set()
+        current["future"].cancel()
+    st.session_state.test_prefetch = None
+
+def take_prefetched_test(wait_timeout=AI_FEATURE_DEADLINES["teacher"]):
+    """Return (questions, params) from the prefetch, waiting for it if still running; None if unavailable"""
+    current = st.session_state.get('test_prefetch')
+    st.session_state.test_prefetch = None
+    if not current or current["cancel"].is_set():
+        return None
+    try:
+        questions, _ = current["future"].result(timeout=wait_timeout)
+    except Exception:
+        return None
+    return (questions, current["params"]) if questions else None
+
+def next_test_params(params, score):
+    """Same test again, or one step harder after a high score"""
+    if score >= PREFETCH_STEP_UP_SCORE and params["difficulty"] in TEST_DIFFICULTIES[:-1]:
+        harder = TEST_DIFFICULTIES[TEST_DIFFICULTIES.index(params["difficulty"]) + 1]
+        return dict(params, difficulty=harder)
+    return params
+
+def start_test(questions, params):
+    """Make questions the active test and begin prefetching the next one"""
+    st.session_state.test_questions = questions
+    st.session_state.test_params = params
+    st.session_state.test_active = True
+    st.session_state.test_answers = {}
+    st.session_state.test_submitted = False
+    start_test_prefetch(params)
+
+# ==================== RESPONSE CACHE ====================
+
+RESPONSE_CACHE_PATH = os.path.join(".study_cache", "ai_responses.sqlite3")
+RESPONSE_CACHE_TTL = 7 * 24 * 3600  # Seconds before a cached answer goes stale
+RESPONSE_CACHE_MAX_ENTRIES = 5000  # LRU bound on the number of cached answers
+
+@st.cache_resource
+def get_response_cache():
+    """Open the on-disk response cache shared by all sessions"""
+    try:
+        os.makedirs(os.path.dirname(RESPONSE_CACHE_PATH), exist_ok=True)
+        conn = sqlite3.connect(RESPONSE_CACHE_PATH, check_same_thread=False)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)")
+        conn.commit()
+    except Exception:
+        conn = None
+    return {"conn": conn, "lock": threading.Lock(), "hits": 0, "misses": 0}
+
+def normalize_prompt(prompt):
+    """Normalize a prompt so trivially different form inputs share a cache entry"""
+    return re.sub(r"\s+", " ", prompt).strip().casefold()
+
+def response_cache_key(prompt, system_role, model, max_tokens, temperature, json_mode=False):
+    """Build the cache key from the normalized prompt, model and parameters"""
+    params = {
+        "prompt": normalize_prompt(prompt),
+        "system_role": system_role,
+        "model": model,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+    }
+    if json_mode:
+        params["json_mode"] = True
+    payload = json.dumps(params, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def response_cache_get(key):
+    """Return a fresh cached response or None (expired entries are dropped)"""
+    cache = get_response_cache()
+    if not cache["conn"]:
+        return None
+    
+    now = time.time()
+    with cache["lock"]:
+        try:
+            row = cache["conn"].execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row and now - row[1] <= RESPONSE_CACHE_TTL:
+                cache["conn"].execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                cache["conn"].commit()
+                cache["hits"] += 1
+                return row[0]
+            if row:
+                cache["conn"].execute("DELETE FROM responses WHERE key = ?", (key,))
+                cache["conn"].commit()
+        except sqlite3.Error:
+            pass
+        cache["misses"] += 1
+        return None
+
+def response_cache_put(key, response):
+    """Store a response, then purge expired entries and evict least recently used ones"""
+    cache = get_response_cache()
+    if not cache["conn"]:
+        return
+    
+    now = time.time()
+    with cache["lock"]:
+        try:
+            conn = cache["conn"]
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, now, now)
+            )
+            conn.execute("DELETE FROM responses WHERE created_at < ?", (now - RESPONSE_CACHE_TTL,))
+            conn.execute("""
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                )
+            """, (RESPONSE_CACHE_MAX_ENTRIES,))
+            conn.commit()
+        except sqlite3.Error:
+            pass
+
+def response_cache_stats():
+    """Hit/miss counters and current size of the response cache"""
+    cache = get_response_cache()
+    entries = 0
+    if cache["conn"]:
+        with cache["lock"]:
+            try:
+                entries = cache["conn"].execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            except sqlite3.Error:
+                pass
+    total = cache["hits"] + cache["misses"]
+    return {
+        "hits": cache["hits"],
+        "misses": cache["misses"],
+        "hit_rate": cache["hits"] / total if total else 0.0,
+        "entries": entries,
+    }
+
+def clear_response_cache():
+    """Drop every cached response"""
+    cache = get_response_cache()
+    if not cache["conn"]:
+        return False
+    with cache["lock"]:
+        try:
+            cache["conn"].execute("DELETE FROM responses")
+            cache["conn"].commit()
+            return True
+        except sqlite3.Error:
+            return False
+
+def cached_ai_call(prompt, system_role="Expert Study Assistant", model="llama-3.3-70b-versatile", force_refresh=False, feature=None):
+    """
+    Memory-free safe_ai_call backed by the persistent response cache.
+    Returns (response, error, from_cache). force_refresh skips the lookup and overwrites the entry.
+    """
+    key = response_cache_key(prompt, system_role, model, AI_MAX_TOKENS, AI_TEMPERATURE)
+    
+    if not force_refresh:
+        cached = response_cache_get(key)
+        if cached is not None:
+            return cached, None, True
+    
+    response, error = safe_ai_call(prompt, system_role=system_role, include_memory=False, model=model, feature=feature)
+    if response:
+        response_cache_put(key, response)
+    return response, error, False
+
+def cached_completion(prompt, system_role="Expert Study Assistant", model="llama-3.3-70b-versatile", force_refresh=False, feature=None, json_mode=False):
+    """
+    Like cached_ai_call but built on complete_ai, so it is safe in worker threads.
+    The caller checks the usage limit. Returns (response, error, from_cache).
+    """
+    key = response_cache_key(prompt, system_role, model, AI_MAX_TOKENS, AI_TEMPERATURE, json_mode)
+    
+    if not force_refresh:
+        cached = response_cache_get(key)
+        if cached is not None:
+            return cached, None, True
+    
+    messages = build_ai_messages(prompt, system_role, include_memory=False)
+    response, error = complete_ai(messages, model=model, feature=feature, json_mode=json_mode)
+    if response:
+        response_cache_put(key, response)
+    return response, error, False
+
+# ==================== CHUNKED GENERATION ====================
+
+QUIZ_CHUNK_SIZE = 5  # Questions per concurrent request
+FLASHCARD_CHUNK_SIZE = 10  # Cards per concurrent request - keeps each answer well under AI_MAX_TOKENS
+CHUNK_FOCUS_HINTS = [
+    "core definitions and key terms",
+    "processes, mechanisms and how things work",
+    "applications and real-world examples",
+    "comparisons, cause and effect, and common misconceptions",
+    "advanced details and edge cases",
+    "history, context and notable facts",
+]
+
+@st.cache_resource
+def get_generation_executor():
+    """Thread pool for concurrent chunk requests"""
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="chunk-gen")
+
+def normalize_item_key(text):
+    """Dedupe key for a card front or question stem"""
+    return re.sub(r"[^\w\s]", "", normalize_prompt(text))
+
+def chunk_counts(total, chunk_size):
+    """Item count of each chunk request"""
+    return [chunk_size] * (total // chunk_size) + ([total % chunk_size] if total % chunk_size else [])
+
+def generate_in_chunks(total, chunk_size, build_prompt, parse_items, item_key, feature, force_refresh=False):
+    """
+    Generate `total` items as concurrent chunks, each with a different focus hint, then merge
+    and deduplicate them. build_prompt(count, hint, avoid) -> prompt, parse_items(text) -> items,
+    item_key(item) -> text to dedupe on. Each answered request counts as one use. Returns (items, error, from_cache).
+    """
+    counts = chunk_counts(total, chunk_size)
+    hints = CHUNK_FOCUS_HINTS if len(counts) > 1 else [None]
+    
+    executor = get_generation_executor()
+    futures = [
+        executor.submit(cached_completion, build_prompt(count, hints[idx % len(hints)], None),
+                        force_refresh=force_refresh, feature=feature, json_mode=True)
+        for idx, count in enumerate(counts)
+    ]
+    
+    items, seen, error, from_cache = [], set(), None, True
+    answered = 0  # AI calls that counted against the usage limit (cache hits are free)
+    
+    def merge(text):
+        for item in parse_items(text):
+            key = normalize_item_key(item_key(item))
+            if key and key not in seen and len(items) < total:
+                seen.add(key)
+                items.append(item)
+    
+    # Merge in submission order so the result doesn't depend on which chunk finished first
+    for future in futures:
+        response, chunk_error, chunk_cached = future.result()
+        from_cache = from_cache and chunk_cached
+        if response and not chunk_cached:
+            answered += 1
+        if response:
+            merge(response)
+        else:
+            error = chunk_error
+    
+    # One top-up request for anything lost to failed chunks, bad items or duplicates
+    missing = total - len(items)
+    if missing > 0 and items:
+        response, chunk_error, _ = cached_completion(
+            build_prompt(missing, None, [item_key(item) for item in items]),
+            force_refresh=True, feature=feature, json_mode=True
+        )
+        from_cache = False
+        if response:
+            answered += 1
+            merge(response)
+        else:
+            error = chunk_error
+    
+    if answered:
+        record_usage(answered)
+    return items, (None if items else error or "Generation failed. Try again!"), from_cache
+
+def build_quiz_prompt(topic, difficulty, count, hint=None, avoid=None):
+    """JSON-mode prompt for one chunk of a quiz"""
+    prompt = f"""Create {count} multiple choice quiz questions about {topic} at {difficulty} level."""
+    if hint:
+        prompt += f"\nFocus on: {hint}."
+    prompt += """
+
+Respond with JSON only, in exactly this shape:
+{"questions": [{"question": "...", "options": {"A": "...", "B": "...", "C": "...", "D": "..."}, "correct": "A", "explanation": "brief explanation"}]}"""
+    if avoid:
+        prompt += "\n\nDo not repeat any of these questions:\n" + "\n".join(f"- {q}" for q in avoid)
+    return prompt
+
+def parse_quiz_questions(text):
+    """Validated quiz questions (test schema plus an explanation) from JSON output"""
+    questions = []
+    for raw in extract_test_json(text):
+        question = validate_test_question(raw)
+        if question:
+            question["explanation"] = str(raw.get("explanation") or "").strip()
+            questions.append(question)
+    return questions
+
+def render_quiz(questions):
+    """Render questions in the quiz's Markdown format with answer key and explanations"""
+    parts = []
+    for number, q in enumerate(questions, 1):
+        options = "\n".join(f"{letter}) {text}" for letter, text in q["options"].items())
+        parts.append(f"**Question {number}:** {q['question']}\n{options}")
+    parts.append("**Answer Key:**\n" + "\n".join(f"{n}. {q['correct']}" for n, q in enumerate(questions, 1)))
+    parts.append("**Explanations:**\n" + "\n".join(f"{n}. {q['explanation'] or '-'}" for n, q in enumerate(questions, 1)))
+    return "\n\n".join(parts)
+
+def build_flashcard_prompt(topic, style_prompt, count, hint=None, avoid=None):
+    """JSON-mode prompt for one chunk of a flashcard deck"""
+    prompt = f"""Create {count} flashcards for studying {topic}.
+{style_prompt}"""
+    if hint:
+        prompt += f"\nFocus on: {hint}."
+    prompt += """
+
+Respond with JSON only, in exactly this shape:
+{"cards": [{"front": "Question/Term/Statement", "back": "Answer/Definition/Explanation"}]}
+
+Make them clear, educational, and test-worthy!"""
+    if avoid:
+        prompt += "\n\nDo not repeat any of these cards:\n" + "\n".join(f"- {front}" for front in avoid)
+    return prompt
+
+def parse_flashcards(text):
+    """Validated {'front', 'back'} cards from JSON output - a truncated answer keeps its complete cards"""
+    cards = []
+    for raw in extract_json_items(text, "cards"):
+        if not isinstance(raw, dict):
+            continue
+        front = " ".join(str(raw.get("front") or "").split())
+        back = " ".join(str(raw.get("back") or "").split())
+        if front and back:
+            cards.append({"front": front, "back": back})
+    return cards
+
+def render_flashcards(cards):
+    """Render cards in the Front:/Back: Markdown format used for display and export"""
+    return "\n\n".join(
+        f"**Card {number}**\nFront: {card['front']}\nBack: {card['back']}"
+        for number, card in enumerate(cards, 1)
+    )
+
+# ==================== WRITE-BEHIND QUEUE ====================
+
+WRITE_BATCH_SIZE = 100  # Max queued writes applied per batch
+WRITE_LINGER = 0.2  # Seconds to wait for more writes before applying a batch
+WRITE_MAX_RETRIES = 3
+WRITE_RETRY_BACKOFF = 0.5  # Seconds, doubled on every retry
+
+@st.cache_resource
+def get_write_queue():
+    """Start the background writer that batches history inserts and profile updates"""
+    wq = {
+        "queue": queue.Queue(),
+        "lock": threading.Lock(),
+        "pending": {},  # user_id -> queued items not yet applied, so a flush waits only for its own user
+        "stats": {"written": 0, "batches": 0, "retries": 0, "dropped": 0, "last_error": None},
+    }
+    wq["applied"] = threading.Condition(wq["lock"])
+    threading.Thread(target=_write_behind_worker, args=(wq,), daemon=True, name="write-behind").start()
+    atexit.register(flush_writes)
+    return wq
+
+def _write_behind_worker(wq):
+    """Drain the queue forever, applying writes in batches"""
+    while True:
+        items = [wq["queue"].get()]
+        deadline = time.time() + WRITE_LINGER
+        while len(items) < WRITE_BATCH_SIZE:
+            try:
+                items.append(wq["queue"].get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+        try:
+            _apply_writes(wq, items)
+        finally:
+            with wq["applied"]:
+                for item in items:
+                    user_id = _item_user(item)
+                    wq["pending"][user_id] -= 1
+                    if not wq["pending"][user_id]:
+                        del wq["pending"][user_id]
+                    wq["queue"].task_done()
+                wq["applied"].notify_all()
+
+def _item_user(item):
+    """User a queued write belongs to"""
+    return item[1]["user_id"] if item[0] == "history" else item[1]
+
+def _enqueue(item):
+    """Queue a write, counting it against its user"""
+    wq = get_write_queue()
+    with wq["lock"]:
+        user_id = _item_user(item)
+        wq["pending"][user_id] = wq["pending"].get(user_id, 0) + 1
+    wq["queue"].put(item)
+
+def _apply_writes(wq, items):
+    """Apply one batch: a single bulk history insert plus one coalesced update per profile and stats row"""
+    history_rows = [item[1] for item in items if item[0] == "history"]
+    stats_users = list(dict.fromkeys(item[1] for item in items if item[0] == "stats"))
+    profile_updates = {}
+    xp_deltas = {}
+    for item in items:
+        if item[0] == "profile":
+            profile_updates.setdefault(item[1], {}).update(item[2])
+        elif item[0] == "xp" and item[1] not in xp_deltas:
+            # Any number of XP events for a user collapse into one atomic increment of their sum
+            xp_deltas[item[1]] = xp_ledger_pending(item[1])
+    
+    operations = []
+    for user_id in dict.fromkeys(row["user_id"] for row in history_rows):
+        # A backfill after the insert would count these rows and then add their pending increments again
+        operations.append((0, lambda user_id=user_id: prime_user_stats(user_id), None))
+    if history_rows:
+        operations.append((len(history_rows), lambda: db.insert_history(history_rows), None))
+    for user_id, fields in profile_updates.items():
+        operations.append((1, lambda user_id=user_id, fields=fields:
+                           db.update_profile(user_id, fields), None))
+    for user_id, (delta, event_count) in xp_deltas.items():
+        if not event_count:
+            continue  # Already written by an earlier batch
+        operations.append((1, lambda user_id=user_id, delta=delta: db.increment_xp(user_id, delta),
+                           lambda total, user_id=user_id, event_count=event_count:
+                           xp_ledger_commit(user_id, event_count, total)))
+    for user_id in stats_users:
+        operations.append((1, lambda user_id=user_id: flush_user_stats(user_id), None))
+    
+    for count, operation, on_success in operations:
+        for attempt in range(WRITE_MAX_RETRIES + 1):
+            try:
+                result = operation()
+                if on_success:
+                    on_success(result)
+                with wq["lock"]:
+                    wq["stats"]["written"] += count
+                break
+            except Exception as e:
+                with wq["lock"]:
+                    wq["stats"]["last_error"] = str(e)
+                    if attempt < WRITE_MAX_RETRIES:
+                        wq["stats"]["retries"] += 1
+                    else:
+                        wq["stats"]["dropped"] += count
+                if attempt < WRITE_MAX_RETRIES:
+                    time.sleep(WRITE_RETRY_BACKOFF * 2 ** attempt)
+    
+    with wq["lock"]:
+        wq["stats"]["batches"] += 1
+
+def enqueue_history_insert(row):
+    """Queue a history row for the next bulk insert"""
+    _enqueue(("history", row))
+
+def enqueue_profile_update(user_id, fields):
+    """Queue a profile update - updates to the same profile in one batch are merged"""
+    _enqueue(("profile", user_id, dict(fields)))
+
+def enqueue_xp_flush(user_id):
+    """Queue a write of the user's folded XP total"""
+    _enqueue(("xp", user_id))
+
+def flush_writes(timeout=10, user_id=None):
+    """Block until the user's queued writes (every user's if None) have been applied, or the timeout passes"""
+    wq = get_write_queue()
+    if user_id is None:
+        drained = lambda: not wq["queue"].unfinished_tasks
+    else:
+        drained = lambda: not wq["pending"].get(user_id)
+    with wq["applied"]:
+        return wq["applied"].wait_for(drained, timeout=timeout)
+
+def flush_user_writes(timeout=10):
+    """flush_writes for the signed-in user only - never waits on other users' backlog"""
+    if not st.session_state.user or st.session_state.get('is_guest', False):
+        return True  # Guests have nothing queued
+    return flush_writes(timeout, user_id=st.session_state.user.id)
+
+def write_queue_stats(user_id=None):
+    """Backlog size (of one user's writes if given) and counters of the write-behind queue"""
+    wq = get_write_queue()
+    with wq["lock"]:
+        stats = dict(wq["stats"])
+        stats["pending"] = wq["pending"].get(user_id, 0) if user_id else wq["queue"].unfinished_tasks
+    return stats
+
+# ==================== XP LEDGER ====================
+
+@st.cache_resource
+def get_xp_ledger():
+    """Process-wide append-only XP event ledger, shared by every session and tab"""
+    return {"lock": threading.Lock(), "users": {}}
+
+def xp_ledger_append(user_id, amount, reason="", seed=0):
+    """Append an XP event and return (old_total, new_total) - seed is the known total for a new user"""
+    ledger = get_xp_ledger()
+    with ledger["lock"]:
+        entry = ledger["users"].setdefault(user_id, {"base": seed, "events": []})
+        old_total = entry["base"] + sum(event["amount"] for event in entry["events"])
+        entry["events"].append({"amount": amount, "reason": reason, "at": time.time()})
+        return old_total, old_total + amount
+
+def xp_ledger_pending(user_id):
+    """XP not yet written to the database and the number of events it covers - (0, 0) if none"""
+    ledger = get_xp_ledger()
+    with ledger["lock"]:
+        entry = ledger["users"].get(user_id)
+        if not entry:
+            return 0, 0
+        return sum(event["amount"] for event in entry["events"]), len(entry["events"])
+
+def xp_ledger_commit(user_id, event_count, stored_total=None):
+    """
+    Drop the first event_count events once their delta has been written. stored_total is the
+    database total after the increment, which also includes XP earned through other processes
+    """
+    ledger = get_xp_ledger()
+    with ledger["lock"]:
+        entry = ledger["users"].get(user_id)
+        if entry:
+            if stored_total is None:
+                entry["base"] += sum(event["amount"] for event in entry["events"][:event_count])
+            else:
+                entry["base"] = stored_total
+            del entry["events"][:event_count]
+
+def xp_ledger_sync(user_id, stored_xp):
+    """Reconcile with the XP stored in Supabase and return the total to display"""
+    ledger = get_xp_ledger()
+    with ledger["lock"]:
+        entry = ledger["users"].get(user_id)
+        if not entry:
+            return stored_xp
+        if not entry["events"]:
+            entry["base"] = stored_xp
+        return entry["base"] + sum(event["amount"] for event in entry["events"])
+
+# ==================== STATS ROLLUP ====================
+
+# Per-user activity counters, kept in a Supabase table so the dashboard reads one small row:
+#   create table user_stats (
+#       user_id uuid primary key references profiles(id) on delete cascade,
+#       chat_messages int not null default 0, notes int not null default 0,
+#       tests int not null default 0, quizzes int not null default 0,
+#       study_seconds bigint not null default 0, updated_at timestamptz
+#   );
+# plus the increment_user_stats function in storage.py. Only deltas are written, so
+# server processes sharing the table never overwrite each other's counts.
+USER_STATS_FIELDS = ("chat_messages", "notes", "tests", "quizzes", "study_seconds")
+USER_STATS_TTL = 300  # Seconds before an idle user's row is re-read from Supabase
+
+@st.cache_resource
+def get_stats_rollup():
+    """Process-wide stats rollup: persisted base totals plus pending increments per user"""
+    return {"lock": threading.Lock(), "users": {}, "disabled": None}
+
+def _stats_entry(user_id):
+    """Get (or create) a user's rollup entry - caller holds the lock"""
+    return get_stats_rollup()["users"].setdefault(user_id, {
+        "base": None,
+        "pending": dict.fromkeys(USER_STATS_FIELDS, 0),
+        "fetched_at": 0,
+        "version": 0,  # Bumped whenever base changes, so a slower fetch can't overwrite a newer base
+    })
+
+def _is_missing_schema(e):
+    """The user_stats table (or its increment function) hasn't been created"""
+    text = str(e).lower()
+    return any(marker in text for marker in ("user_stats", "increment_user_stats")) and any(
+        marker in text for marker in ("does not exist", "no such table", "could not find", "pgrst205", "pgrst202"))
+
+def _disable_stats_rollup(e):
+    """Stop tracking for the life of the process instead of retrying every write"""
+    rollup = get_stats_rollup()
+    with rollup["lock"]:
+        if not rollup["disabled"]:
+            rollup["disabled"] = str(e)
+            rollup["users"].clear()
+            logger.warning("stats rollup disabled - user_stats schema missing: %s", e)
+
+def stats_rollup_enabled():
+    return not get_stats_rollup()["disabled"]
+
+def _fetch_user_stats(user_id):
+    """Read a user's stats row, backfilling it from exact counts the first time"""
+    row = db.get_user_stats(user_id)
+    if row:
+        return {field: row.get(field) or 0 for field in USER_STATS_FIELDS}
+    
+    # One-off backfill for users who predate the rollup
+    profile = db.get_profile(user_id, "total_study_time")
+    base = dict.fromkeys(USER_STATS_FIELDS, 0)
+    base["chat_messages"] = db.count_history(user_id)
+    base["notes"] = db.count_notes(user_id)
+    base["study_seconds"] = (profile.get("total_study_time") or 0) if profile else 0
+    
+    # Notes and study time are written before record_stat, so their pending increments are already
+    # in the counts above. History rows are only inserted after prime_user_stats has run.
+    with get_stats_rollup()["lock"]:
+        pending = _stats_entry(user_id)["pending"]
+        for field in ("notes", "study_seconds"):
+            base[field] -= pending[field]
+    db.create_user_stats(dict(base, user_id=user_id, updated_at=datetime.now().isoformat()))
+    
+    # Another process may have created the row first - its totals win
+    row = db.get_user_stats(user_id)
+    return {field: row.get(field) or 0 for field in USER_STATS_FIELDS} if row else base
+
+def _ensure_stats_base(user_id, max_age=None):
+    """Load the persisted base totals if missing (or older than max_age with nothing pending)"""
+    rollup = get_stats_rollup()
+    with rollup["lock"]:
+        entry = _stats_entry(user_id)
+        idle = not any(entry["pending"].values())
+        stale = max_age is not None and idle and time.time() - entry["fetched_at"] > max_age
+        if entry["base"] is not None and not stale:
+            return
+        version = entry["version"]
+    
+    try:
+        base = _fetch_user_stats(user_id)
+    except Exception as e:
+        if _is_missing_schema(e):
+            _disable_stats_rollup(e)
+        raise
+    with rollup["lock"]:
+        entry = _stats_entry(user_id)
+        if entry["version"] == version:  # Otherwise a flush stored fresher totals meanwhile
+            entry["base"] = base
+            entry["version"] += 1
+        entry["fetched_at"] = time.time()
+
+def record_stat(field, amount=1):
+    """Count an activity for the current user; the stats row is updated in the background"""
+    if st.session_state.get('is_guest', False) or not db or not st.session_state.user or not stats_rollup_enabled():
+        return
+    
+    user_id = st.session_state.user.id
+    rollup = get_stats_rollup()
+    with rollup["lock"]:
+        _stats_entry(user_id)["pending"][field] += amount
+    _enqueue(("stats", user_id))
+
+def reset_stats(*fields):
+    """Zero counters whose underlying rows were deleted (chat cleared, all data deleted)"""
+    if not stats_rollup_enabled():
+        return
+    current = load_user_stats()
+    for field in fields:
+        if current[field]:
+            record_stat(field, -current[field])
+
+def prime_user_stats(user_id):
+    """Write-behind operation: load (or backfill) a user's base before their history rows are inserted"""
+    if not stats_rollup_enabled():
+        return
+    try:
+        _ensure_stats_base(user_id)
+    except Exception as e:
+        if not _is_missing_schema(e):
+            raise
+
+def flush_user_stats(user_id):
+    """Write-behind operation: add a user's pending increments to their row, then take its totals as base"""
+    if not stats_rollup_enabled():
+        return
+    
+    try:
+        _ensure_stats_base(user_id)  # Backfills users who predate the rollup before the first increment
+        
+        rollup = get_stats_rollup()
+        with rollup["lock"]:
+            applied = dict(_stats_entry(user_id)["pending"])
+        if not any(applied.values()):
+            return
+        
+        row = db.increment_user_stats(user_id, applied)
+    except Exception as e:
+        if _is_missing_schema(e):
+            _disable_stats_rollup(e)
+            return  # Not worth retrying - the queue moves on
+        raise
+    
+    with rollup["lock"]:
+        entry = _stats_entry(user_id)
+        for field in USER_STATS_FIELDS:
+            entry["pending"][field] -= applied[field]
+        if row:
+            # The row's totals include increments from other processes
+            entry["base"] = {field: row.get(field) or 0 for field in USER_STATS_FIELDS}
+        else:
+            for field in USER_STATS_FIELDS:
+                entry["base"][field] += applied[field]
+        entry["version"] += 1
+
+def load_user_stats():
+    """Current user's totals - served from the rollup, with at most one small query per USER_STATS_TTL"""
+    if not stats_rollup_enabled():
+        raise RuntimeError("Activity tracking unavailable")
+    user_id = st.session_state.user.id
+    _ensure_stats_base(user_id, max_age=USER_STATS_TTL)
+    
+    rollup = get_stats_rollup()
+    with rollup["lock"]:
+        entry = _stats_entry(user_id)
+        return {field: entry["base"][field] + entry["pending"][field] for field in USER_STATS_FIELDS}
+
+# ==================== DATA LOADER ====================
+
+RECENT_HISTORY_LIMIT = 10  # One fetch serves Home (5 rows) and Dashboard (10 rows)
+SHARED_READ_TTL = 30  # Seconds a keyed read is re-used across reruns and pages
+
+logger = logging.getLogger("study_ai")
+if not logger.handlers:  # The script re-executes on every rerun
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(_log_handler)
+    logger.setLevel(logging.INFO)
+
+# Run state lives in _rerun_locals(): Streamlit runs each session's script on its own
+# thread, and worker threads (write queue, prefetch) never see a rerun so aren't counted
+
+def begin_rerun():
+    """Start memoizing reads and counting round trips for this script run"""
+    run = _rerun_locals()
+    run.reads = {}
+    run.feature = "app"  # Profile load and sidebar, until route_app knows the page
+    run.stats = {"round_trips": 0, "ai_calls": 0, "coalesced": 0, "started": time.time()}
+
+def end_rerun(page):
+    """Log how many round trips the script run made"""
+    run = _rerun_locals()
+    stats = getattr(run, "stats", None)
+    if stats is None:
+        return
+    elapsed = time.time() - stats.pop("started")
+    st.session_state.last_rerun_stats = dict(stats, page=page, elapsed=elapsed)
+    totals = st.session_state.rerun_totals
+    totals["runs"] += 1
+    totals["round_trips"] += stats["round_trips"]
+    totals["ai_calls"] += stats["ai_calls"]
+    totals["elapsed"] += elapsed
+    logger.info("rerun page=%s round_trips=%d ai_calls=%d coalesced=%d elapsed=%.3fs",
+                page, stats["round_trips"], stats["ai_calls"], stats["coalesced"], elapsed)
+    run.reads = None
+    run.stats = None
+    run.feature = None
+
+def load_once(key, fetch, ttl=0):
+    """DataLoader-style read - callers asking for the same key share one fetch per run (or per ttl seconds across pages)"""
+    run = _rerun_locals()
+    reads = getattr(run, "reads", None)
+    stats = getattr(run, "stats", None)
+    if reads is not None and key in reads:
+        stats["coalesced"] += 1
+        return reads[key]
+    
+    shared = st.session_state.shared_reads
+    if ttl and key in shared and time.time() - shared[key]["fetched_at"] < ttl:
+        value = shared[key]["value"]
+        if stats is not None:
+            stats["coalesced"] += 1
+    else:
+        value = fetch()
+        if ttl:
+            shared[key] = {"value": value, "fetched_at": time.time()}
+    
+    if reads is not None:
+        reads[key] = value
+    return value
+
+def invalidate_reads(name):
+    """Drop memoized reads for one kind of data (call after writing to the table behind it)"""
+    for store in (getattr(_rerun_locals(), "reads", None), st.session_state.shared_reads):
+        if store:
+            for key in [k for k in store if k[0] == name]:
+                del store[key]
+
+def load_recent_history(limit=RECENT_HISTORY_LIMIT):
+    """Latest history rows, newest first - every page shares one query for the largest window"""
+    user_id = st.session_state.user.id
+    
+    def fetch():
+        flush_user_writes(timeout=1)  # Include messages still sitting in the write queue
+        return db.history_page(user_id, limit=RECENT_HISTORY_LIMIT)
+    
+    return load_once(("recent_history", user_id), fetch, ttl=SHARED_READ_TTL)[:limit]
+
 # ==================== DATABASE FUNCTIONS ====================
 
+PROFILE_CACHE_TTL = 300  # Seconds before the cached profile is re-fetched from the database
+
+def load_profile(force=False):
+    """Load the user's profile, re-using the session copy until it is invalidated or stale"""
+    cache = st.session_state.profile_cache
+    user_id = st.session_state.user.id
+    
+    if (not force and cache and cache['user_id'] == user_id
+            and time.time() - cache['fetched_at'] < PROFILE_CACHE_TTL):
+        return cache['data']
+    
+    # Let queued XP updates land first so the fresh copy isn't stale
+    flush_user_writes(timeout=2)
+    profile = db.get_profile(user_id)
+    if not profile:
+        st.session_state.profile_cache = None
+        return None
+    
+    st.session_state.profile_cache = {
+        'user_id': user_id,
+        'data': profile,
+        'fetched_at': time.time()
+    }
+    return profile
+
+def invalidate_profile_cache():
+    """Force the next rerun to re-fetch the profile (call after writing to profiles)"""
+    st.session_state.profile_cache = None
+
 def save_chat_message(role, content):
     """Save chat message to database - only for logged-in users"""
     # Don't save for guests
     if st.session_state.get('is_guest', False):
         return True  # Return True so app doesn't break
     
-    if not supabase or not st.session_state.user:
+    if not db or not st.session_state.user:
         return False
     
     try:
-        supabase.table("history").insert({
+        enqueue_history_insert({
             "user_id": st.session_state.user.id,
             "role": role,
             "content": content,
             "created_at": datetime.now().isoformat()
-        }).execute()
+        })
+        record_usage()
+        record_stat("chat_messages")
+        invalidate_reads("recent_history")
         return True
     except:
         return False
 
-def load_chat_history():
-    """Load recent chat history - only for logged-in users"""
+CHAT_PAGE_SIZE = 50  # Messages fetched per history page
+CHAT_RENDER_WINDOW = 30  # Most recent messages rendered on each rerun
+
+def load_chat_history(before=None, limit=CHAT_PAGE_SIZE):
+    """
+    Load the latest chat messages, or the page just older than `before` (a row with created_at/id),
+    oldest first - only for logged-in users. Returns (rows, has_more).
+    """
     # Guests don't have history
     if st.session_state.get('is_guest', False):
-        return []
+        return [], False
     
-    if not supabase or not st.session_state.user:
-        return []
+    if not db or not st.session_state.user:
+        return [], False
     
     try:
-        res = supabase.table("history").select("*").eq(
-            "user_id", st.session_state.user.id
-        ).order("created_at", desc=False).limit(50).execute()
-        
-        return res.data if res.data else []
+        # Newest first so the limit keeps the latest page, then flip for display
+        rows = db.history_page(st.session_state.user.id, before=before, limit=limit + 1,
+                               columns="id, role, content, created_at")
+        return list(reversed(rows[:limit])), len(rows) > limit
     except:
-        return []
+        return [], False
+
+def reload_chat_history():
+    """Replace the session chat with the latest page of saved history"""
+    flush_user_writes(timeout=2)  # Include turns still sitting in the write-behind queue
+    history, has_more = load_chat_history()
+    st.session_state.chat_messages = [
+        {"role": h["role"], "content": h["content"]}
+        for h in history
+    ]
+    st.session_state.chat_oldest = history[0] if history else None
+    st.session_state.chat_has_older = has_more
+    st.session_state.chat_render_window = CHAT_RENDER_WINDOW
+    reset_chat_summary()
+
+def reset_chat_paging():
+    """Forget the history cursor (chat cleared or user changed)"""
+    st.session_state.chat_oldest = None
+    st.session_state.chat_has_older = False
+    st.session_state.chat_render_window = CHAT_RENDER_WINDOW
+
+def load_older_chat():
+    """Show more of the conversation: reveal hidden messages first, then page older ones in from the database"""
+    messages = st.session_state.chat_messages
+    window = st.session_state.chat_render_window or CHAT_RENDER_WINDOW
+    
+    if len(messages) > window:
+        st.session_state.chat_render_window = window + CHAT_PAGE_SIZE
+        return
+    
+    if not st.session_state.chat_has_older or not st.session_state.chat_oldest:
+        return
+    
+    older, has_more = load_chat_history(before=st.session_state.chat_oldest)
+    if older:
+        st.session_state.chat_messages = [
+            {"role": h["role"], "content": h["content"]}
+            for h in older
+        ] + messages
+        st.session_state.chat_oldest = older[0]
+        st.session_state.chat_render_window = window + len(older)
+        # Older turns predate the rolling summary - keep them out of the model's memory
+        st.session_state.chat_summary_upto += len(older)
+        job = st.session_state.chat_summary_job
+        if job:
+            job["upto"] += len(older)
+    st.session_state.chat_has_older = has_more
 
 def clear_chat_history():
     """Clear all chat history"""
     # For guests, just clear session
     if st.session_state.get('is_guest', False):
         st.session_state.chat_messages = []
+        reset_chat_summary()
+        reset_chat_paging()
         return True
     
-    if not supabase or not st.session_state.user:
+    if not db or not st.session_state.user:
         return False
     
     try:
-        supabase.table("history").delete().eq(
-            "user_id", st.session_state.user.id
-        ).execute()
+        flush_user_writes()  # Queued rows would otherwise reappear after the delete
+        db.delete_history(st.session_state.user.id)
+        reset_stats("chat_messages")
+        invalidate_reads("recent_history")
         st.session_state.chat_messages = []
+        reset_chat_summary()
+        reset_chat_paging()
         return True
     except:
         return False
@@ -397,17 +2058,21 @@ def save_note(title, content, tags=""):
     if st.session_state.get('is_guest', False):
         return False
     
-    if not supabase or not st.session_state.user:
+    if not db or not st.session_state.user:
         return False
     
     try:
-        supabase.table("notes").insert({
+        saved = db.insert_note({
             "user_id": st.session_state.user.id,
             "title": title,
             "content": content,
             "tags": tags,
             "created_at": datetime.now().isoformat()
-        }).execute()
+        })
+        for note in saved:
+            index_note(note)
+        reset_notes_list()
+        record_stat("notes")
         return True
     except:
         return False
@@ -418,28 +2083,212 @@ def load_notes():
     if st.session_state.get('is_guest', False):
         return []
     
-    if not supabase or not st.session_state.user:
+    if not db or not st.session_state.user:
         return []
     
     try:
-        res = supabase.table("notes").select("*").eq(
-            "user_id", st.session_state.user.id
-        ).order("created_at", desc=True).execute()
-        return res.data if res.data else []
+        return db.notes_page(st.session_state.user.id)
     except:
         return []
 
+NOTES_PAGE_SIZES = [10, 20, 50]
+
+def load_notes_page(page_size, cursor=None):
+    """
+    One page of note metadata (no content), newest first.
+    Keyset pagination on (created_at, id): cursor is the last row of the previous page.
+    Returns (rows, has_more).
+    """
+    if st.session_state.get('is_guest', False) or not db or not st.session_state.user:
+        return [], False
+    
+    try:
+        rows = db.notes_page(st.session_state.user.id, before=cursor, limit=page_size + 1,
+                             columns="id, title, tags, created_at")
+        return rows[:page_size], len(rows) > page_size
+    except:
+        return [], False
+
+def get_notes_list(page_size):
+    """Session state for the paginated notes list, loading the first page when needed"""
+    notes_list = st.session_state.notes_list
+    if not notes_list or notes_list["page_size"] != page_size:
+        items, has_more = load_notes_page(page_size)
+        notes_list = {"page_size": page_size, "items": items, "has_more": has_more}
+        st.session_state.notes_list = notes_list
+    return notes_list
+
+def load_more_notes():
+    """Append the next page to the notes list"""
+    notes_list = st.session_state.notes_list
+    if notes_list and notes_list["has_more"]:
+        items, has_more = load_notes_page(notes_list["page_size"], cursor=notes_list["items"][-1])
+        notes_list["items"].extend(items)
+        notes_list["has_more"] = has_more
+
+def reset_notes_list():
+    """Forget loaded pages so the list is re-fetched (after a note is added or removed)"""
+    st.session_state.notes_list = None
+
+def load_note_content(note_id):
+    """Fetch one note's content, cached for the session"""
+    cache = st.session_state.note_content_cache
+    if note_id not in cache:
+        try:
+            note = db.get_note(note_id, "content")
+            cache[note_id] = note.get('content', '') if note else ''
+        except:
+            return None
+    return cache[note_id]
+
 def delete_note(note_id):
     """Delete a note"""
-    if not supabase or st.session_state.get('is_guest', False):
+    if not db or st.session_state.get('is_guest', False):
         return False
     
     try:
-        supabase.table("notes").delete().eq("id", note_id).execute()
+        db.delete_note(note_id)
+        unindex_note(note_id)
+        record_stat("notes", -1)
+        st.session_state.note_content_cache.pop(note_id, None)
+        reset_notes_list()
         return True
     except:
         return False
 
+# ==================== NOTES SEARCH ====================
+
+NOTES_INDEX_TTL = 600  # Seconds before a user's notes are fully re-indexed from Supabase
+NOTES_SEARCH_LIMIT = 50
+
+@st.cache_resource
+def get_notes_index():
+    """In-process SQLite FTS5 mirror of notes (title, tags, content), shared by all sessions"""
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE notes_fts USING fts5(
+                title, tags, content,
+                note_id UNINDEXED, user_id UNINDEXED, created_at UNINDEXED,
+                tokenize = 'unicode61 remove_diacritics 2',
+                prefix = '2 3'
+            )
+        """)
+    except sqlite3.OperationalError:
+        conn = None  # SQLite built without FTS5 - search falls back to substring matching
+    # syncing: users whose notes are being fetched; edits: per-user count of single-note changes
+    return {"conn": conn, "lock": threading.Lock(), "synced": {}, "syncing": set(), "edits": {}}
+
+def _index_rows(conn, notes):
+    """Insert notes into the FTS table - caller holds the lock"""
+    conn.executemany(
+        "INSERT INTO notes_fts (title, tags, content, note_id, user_id, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            (note.get('title') or "", note.get('tags') or "", note.get('content') or "",
+             str(note['id']), str(note.get('user_id', "")), note.get('created_at') or "")
+            for note in notes
+        ]
+    )
+
+def index_note(note):
+    """Add or replace a single note in the search index"""
+    index = get_notes_index()
+    if not index["conn"]:
+        return
+    with index["lock"]:
+        index["conn"].execute("DELETE FROM notes_fts WHERE note_id = ?", (str(note['id']),))
+        _index_rows(index["conn"], [note])
+        _count_edit(index, note.get('user_id'))
+
+def unindex_note(note_id):
+    """Remove a note from the search index"""
+    index = get_notes_index()
+    if not index["conn"]:
+        return
+    with index["lock"]:
+        row = index["conn"].execute("SELECT user_id FROM notes_fts WHERE note_id = ?", (str(note_id),)).fetchone()
+        index["conn"].execute("DELETE FROM notes_fts WHERE note_id = ?", (str(note_id),))
+        if row:
+            _count_edit(index, row[0])
+
+def _count_edit(index, user_id):
+    """Note a single-note change, so a rebuild fetched before it isn't marked fresh - caller holds the lock"""
+    user_id = str(user_id)
+    index["edits"][user_id] = index["edits"].get(user_id, 0) + 1
+
+def ensure_notes_index(load_all_notes):
+    """
+    (Re)build the current user's slice of the index if it was never built or has gone stale.
+    The notes are fetched outside the lock so other sessions' searches and edits never wait on it.
+    """
+    index = get_notes_index()
+    user_id = str(st.session_state.user.id)
+    if not index["conn"]:
+        return False
+    
+    with index["lock"]:
+        if time.time() - index["synced"].get(user_id, 0) < NOTES_INDEX_TTL:
+            return True
+        if user_id in index["syncing"]:
+            return True  # Another session is already re-indexing this user - search what is there
+        index["syncing"].add(user_id)
+        edits = index["edits"].get(user_id, 0)
+    
+    try:
+        notes = load_all_notes()
+        with index["lock"]:
+            index["conn"].execute("DELETE FROM notes_fts WHERE user_id = ?", (user_id,))
+            _index_rows(index["conn"], [dict(note, user_id=user_id) for note in notes])
+            if index["edits"].get(user_id, 0) == edits:
+                index["synced"][user_id] = time.time()
+            # Otherwise a note changed mid-fetch and may be missing - the next search re-indexes again
+    finally:
+        with index["lock"]:
+            index["syncing"].discard(user_id)
+    return True
+
+def invalidate_notes_index():
+    """Make the next search re-index the current user's notes"""
+    get_notes_index()["synced"].pop(str(st.session_state.user.id), None)
+
+def build_fts_query(text):
+    """Turn free text into an FTS5 query: every word must match, each as a prefix"""
+    tokens = re.findall(r"\w+", text.lower())
+    return " AND ".join(f'"{token}"*' for token in tokens)
+
+def search_notes(query, limit=NOTES_SEARCH_LIMIT):
+    """
+    Ranked full-text search over the user's notes (title weighted above tags above content).
+    Returns note dicts with a highlighted 'snippet', or None if the index is unavailable.
+    """
+    index = get_notes_index()
+    fts_query = build_fts_query(query)
+    if not index["conn"]:
+        return None
+    if not fts_query:
+        return []
+    
+    with index["lock"]:
+        rows = index["conn"].execute("""
+            SELECT note_id, title, tags, content, created_at,
+                   snippet(notes_fts, 2, '**', '**', '…', 16),
+                   bm25(notes_fts, 10.0, 5.0, 1.0) AS score
+            FROM notes_fts
+            WHERE notes_fts MATCH ? AND user_id = ?
+            ORDER BY score
+            LIMIT ?
+        """, (fts_query, str(st.session_state.user.id), limit)).fetchall()
+    
+    return [
+        {"id": _note_id(row[0]), "title": row[1], "tags": row[2], "content": row[3],
+         "created_at": row[4], "snippet": row[5]}
+        for row in rows
+    ]
+
+def _note_id(value):
+    """The index stores ids as text - give back the database's integer id so content-cache lookups hit"""
+    return int(value) if str(value).isdigit() else value
+
 # ==================== AUTHENTICATION ====================
 
 def login_screen():
@@ -499,11 +2348,7 @@ def login_screen():
                 else:
                     try:
                         with st.spinner("🔐 Logging in..."):
-                            res = supabase.auth.sign_in_with_password({
-                                "email": login_email,
-                                "password": login_pass
-                            })
-                            st.session_state.user = res.user
+                            st.session_state.user = db.sign_in(login_email, login_pass)
                             st.session_state.is_guest = False
                             st.success("✅ Login successful!")
                             st.balloons()
@@ -550,19 +2395,16 @@ def login_screen():
                 else:
                     try:
                         with st.spinner("🎨 Creating your account..."):
-                            res = supabase.auth.sign_up({
-                                "email": signup_email,
-                                "password": signup_pass
-                            })
+                            user = db.sign_up(signup_email, signup_pass)
                             
-                            if res.user:
+                            if user:
                                 st.success("✅ Account created successfully!")
                                 st.info("📧 Please check your email to verify your account")
                                 st.balloons()
                                 
                                 # Auto-login if email confirmed
-                                if hasattr(res.user, 'email_confirmed_at') and res.user.email_confirmed_at:
-                                    st.session_state.user = res.user
+                                if hasattr(user, 'email_confirmed_at') and user.email_confirmed_at:
+                                    st.session_state.user = user
                                     st.session_state.is_guest = False
                                     st.success("🎉 You're now logged in!")
                                     time.sleep(1)
@@ -637,14 +2479,14 @@ def username_setup_screen():
             else:
                 try:
                     # Check if username exists
-                    existing = supabase.table("profiles").select("id").eq("username", username_input).execute()
+                    existing = db.find_profile(username_input)
                     
-                    if existing.data:
+                    if existing:
                         st.error("❌ Username already taken! Try another.")
                     else:
                         # Create profile
                         try:
-                            supabase.table("profiles").insert({
+                            db.insert_profile({
                                 "id": st.session_state.user.id,
                                 "username": username_input,
                                 "avatar": selected_avatar,
@@ -654,17 +2496,18 @@ def username_setup_screen():
                                 "study_streak": 0,
                                 "total_study_time": 0,
                                 "created_at": datetime.now().isoformat()
-                            }).execute()
+                            })
                         except:
                             # Fallback without optional columns
-                            supabase.table("profiles").insert({
+                            db.insert_profile({
                                 "id": st.session_state.user.id,
                                 "username": username_input,
                                 "xp": 0,
                                 "is_premium": False,
                                 "created_at": datetime.now().isoformat()
-                            }).execute()
+                            })
                         
+                        invalidate_profile_cache()
                         st.success(f"✅ Welcome, {username_input}! 🎉")
                         st.balloons()
                         time.sleep(1)
@@ -732,10 +2575,11 @@ def show_sidebar():
                 if st.button("Activate Premium"):
                     if code in ["STUDY777", "PREMIUM2025", "AARYA"]:
                         try:
-                            supabase.table("profiles").update({
+                            db.update_profile(st.session_state.user.id, {
                                 "is_premium": True
-                            }).eq("id", st.session_state.user.id).execute()
+                            })
                             st.session_state.user_data['is_premium'] = True
+                            invalidate_profile_cache()
                             st.success("💎 Premium activated!")
                             st.balloons()
                             time.sleep(1)
@@ -780,7 +2624,7 @@ def show_sidebar():
         # Usage stats
         usage = get_daily_usage()
         api_calls = st.session_state.api_calls_today
-        limit = 1000 if is_premium else 100
+        limit = get_usage_limit()
         
         st.caption(f"Today's Usage: {usage}/{limit}")
         st.caption(f"API Calls: {api_calls}/20")
@@ -794,13 +2638,32 @@ def show_sidebar():
         st.caption("✨ Made by Aarya")
         st.caption("⚡ Powered by Groq AI")
         
+        health = get_ai_health()
+        if health["status"] == "ok":
+            st.caption("🟢 AI online")
+        elif health["status"] == "error":
+            st.caption(f"🔴 AI unreachable: {health['detail'][:80]}")
+        else:
+            st.caption("🟡 Checking AI status...")
+        if db.backend == "sqlite":
+            st.caption("💾 Local storage (SQLite)")
+        if ai_provider.name == "replay":
+            st.caption("🎞️ Replaying recorded AI answers")
+        
         if st.button("🚪 Logout", use_container_width=True):
+            flush_user_writes()
             try:
-                supabase.auth.sign_out()
+                db.sign_out()
             except:
                 pass
             st.session_state.user = None
             st.session_state.chat_messages = []
+            reset_chat_summary()
+            reset_chat_paging()
+            cancel_test_prefetch()
+            reset_notes_list()
+            st.session_state.note_content_cache = {}
+            invalidate_profile_cache()
             st.success("Logged out!")
             st.rerun()
     
@@ -861,12 +2724,10 @@ def show_home():
     st.write("### 📈 Recent Activity")
     
     try:
-        recent = supabase.table("history").select("*").eq(
-            "user_id", st.session_state.user.id
-        ).order("created_at", desc=True).limit(5).execute()
+        recent = load_recent_history(limit=5)
         
-        if recent.data:
-            for activity in recent.data:
+        if recent:
+            for activity in recent:
                 with st.expander(f"{activity['role'].title()}: {activity['content'][:50]}..."):
                     st.write(activity['content'])
                     st.caption(f"🕒 {activity['created_at'][:19]}")
@@ -899,11 +2760,7 @@ def show_chat():
         st.write("💡 Ask anything!")
     with col2:
         if st.button("🔄 Reload", key="reload_chat"):
-            history = load_chat_history()
-            st.session_state.chat_messages = [
-                {"role": h["role"], "content": h["content"]}
-                for h in history
-            ]
+            reload_chat_history()
             st.success("Reloaded!")
             st.rerun()
     with col3:
@@ -917,13 +2774,35 @@ def show_chat():
     
     st.markdown("---")
     
-    # Display messages
-    for message in st.session_state.chat_messages:
+    # Display only the most recent window of messages
+    messages = st.session_state.chat_messages
+    window = st.session_state.chat_render_window or CHAT_RENDER_WINDOW
+    
+    if len(messages) > window or st.session_state.chat_has_older:
+        if st.button("⬆️ Load older messages", key="older_chat"):
+            load_older_chat()
+            st.rerun()
+    
+    for message in messages[-window:]:
         with st.chat_message(message["role"]):
             st.write(message["content"])
     
+    if window > CHAT_RENDER_WINDOW:
+        if st.button("⬇️ Back to latest", key="latest_chat"):
+            st.session_state.chat_render_window = CHAT_RENDER_WINDOW
+            st.rerun()
+    
     # Chat input
     if prompt := st.chat_input("Type your question..."):
+        # Checked before the question is saved, so a turn is never left without its answer
+        limit_error = check_usage_limit(chat_turn_usage())
+        if limit_error:
+            st.error(limit_error)
+            return
+        
+        # A new turn jumps back to the latest messages
+        st.session_state.chat_render_window = CHAT_RENDER_WINDOW
+        
         # Add user message
         st.session_state.chat_messages.append({"role": "user", "content": prompt})
         
@@ -933,25 +2812,24 @@ def show_chat():
         # Save to DB
         save_chat_message("user", prompt)
         
-        # Get AI response
-        with st.spinner("🤔 Thinking..."):
-            response, error = safe_ai_call(prompt, include_memory=True)
+        # Stream AI response
+        with st.chat_message("assistant"):
+            stream, error = safe_ai_call_stream(prompt, include_memory=True)
+            response = st.write_stream(stream) if stream else None
         
         if response:
             st.session_state.chat_messages.append({"role": "assistant", "content": response})
             
-            with st.chat_message("assistant"):
-                st.write(response)
-            
-            # Save and award XP
+            # Save and award XP once the full response has arrived
             save_chat_message("assistant", response)
             increment_usage()
             award_xp(5, "Chat message")
             check_achievement('first_chat')
+            update_chat_summary()
             
             st.rerun()
         else:
-            st.error(error)
+            st.error(error or "No response received. Please try again.")
 
 def show_quiz_generator():
     """Quiz generator feature"""
@@ -967,35 +2845,28 @@ def show_quiz_generator():
         with col2:
             num_q = st.slider("❓ Questions", 3, 10, 5)
         
+        force_refresh = st.checkbox("🔄 Generate a fresh quiz (skip cache)")
+        
         submit = st.form_submit_button("🎯 Generate Quiz", use_container_width=True, type="primary")
         
         if submit and topic:
-            prompt = f"""Create a {num_q}-question multiple choice quiz about {topic} at {difficulty} level.
-
-Format each question EXACTLY like this:
-
-**Question 1:** [question text]
-A) [option]
-B) [option]
-C) [option]
-D) [option]
-
-[Repeat for all {num_q} questions]
-
-**Answer Key:**
-1. [correct letter]
-2. [correct letter]
-etc.
-
-**Explanations:**
-1. [brief explanation]
-2. [brief explanation]
-etc."""
+            limit_error = check_usage_limit(len(chunk_counts(num_q, QUIZ_CHUNK_SIZE)))
             
-            with st.spinner("🎨 Creating your quiz..."):
-                quiz, error = safe_ai_call(prompt, include_memory=False)
+            if limit_error:
+                quiz, error, from_cache = None, limit_error, False
+            else:
+                with st.spinner("🎨 Creating your quiz..."):
+                    questions, error, from_cache = generate_in_chunks(
+                        num_q, QUIZ_CHUNK_SIZE,
+                        lambda count, hint, avoid: build_quiz_prompt(topic, difficulty, count, hint, avoid),
+                        parse_quiz_questions, lambda q: q["question"],
+                        feature="quiz", force_refresh=force_refresh
+                    )
+                quiz = render_quiz(questions) if questions else None
             
             if quiz:
+                if from_cache:
+                    st.caption("⚡ Served from cache - tick 'Generate a fresh quiz' for a new one")
                 st.markdown("---")
                 st.markdown(quiz)
                 st.markdown("---")
@@ -1008,6 +2879,7 @@ etc."""
                 )
                 
                 award_xp(10, "Quiz generated")
+                record_stat("quizzes")
                 check_achievement('quiz_master')
             else:
                 st.error(error)
@@ -1040,66 +2912,21 @@ def show_teacher_mode():
             
             col3, col4 = st.columns(2)
             with col3:
-                difficulty = st.selectbox("🎯 Difficulty", ["Easy", "Medium", "Hard", "Expert"])
+                difficulty = st.selectbox("🎯 Difficulty", TEST_DIFFICULTIES)
             with col4:
                 num_q = st.slider("❓ Questions", 3, 10, 5)
             
             submit = st.form_submit_button("🎯 Generate Test", use_container_width=True, type="primary")
             
             if submit and subject:
-                prompt = f"""Create a {num_q}-question multiple choice test about {subject} - {topic} ({difficulty}).
-
-Format EXACTLY:
-
-QUESTION 1
-[question]
-A) [option]
-B) [option]
-C) [option]
-D) [option]
-CORRECT_ANSWER: [letter]
-
-[Repeat for all questions]"""
-                
                 with st.spinner("👨‍🏫 Creating test..."):
-                    test_content, error = safe_ai_call(prompt, include_memory=False)
+                    questions, error = generate_test(subject, topic, difficulty, num_q)
                 
-                if test_content:
-                    # Parse test
-                    questions = []
-                    lines = test_content.split('\n')
-                    current_q = {}
-                    
-                    for line in lines:
-                        line = line.strip()
-                        
-                        if line.startswith('QUESTION'):
-                            if current_q and 'question' in current_q:
-                                questions.append(current_q)
-                            current_q = {'options': {}, 'number': len(questions) + 1}
-                        elif line and not line.startswith(('A)', 'B)', 'C)', 'D)', 'CORRECT_ANSWER')):
-                            if 'question' not in current_q and len(line) > 5:
-                                current_q['question'] = line
-                        elif line.startswith(('A)', 'B)', 'C)', 'D)')):
-                            letter = line[0]
-                            text = line[2:].strip()
-                            current_q['options'][letter] = text
-                        elif 'CORRECT_ANSWER' in line:
-                            answer = line.split(':')[1].strip()
-                            current_q['correct'] = answer
-                    
-                    if current_q and 'question' in current_q:
-                        questions.append(current_q)
-                    
-                    if questions:
-                        st.session_state.test_questions = questions
-                        st.session_state.test_active = True
-                        st.session_state.test_answers = {}
-                        st.session_state.test_submitted = False
-                        st.success("✅ Test ready! Good luck!")
-                        st.rerun()
-                    else:
-                        st.error("Failed to generate test. Try again!")
+                if questions:
+                    start_test(questions, {"subject": subject, "topic": topic,
+                                           "difficulty": difficulty, "num_q": num_q})
+                    st.success("✅ Test ready! Good luck!")
+                    st.rerun()
                 else:
                     st.error(error)
     
@@ -1136,6 +2963,7 @@ CORRECT_ANSWER: [letter]
                 st.error(f"⚠️ Answer all questions! ({len(st.session_state.test_answers)}/{len(st.session_state.test_questions)})")
             else:
                 st.session_state.test_submitted = True
+                st.session_state.test_xp_awarded = False
                 st.rerun()
     
     else:
@@ -1192,21 +3020,145 @@ CORRECT_ANSWER: [letter]
             
             st.markdown("---")
         
-        # Award XP
+        # Award XP once per submitted test, not on every rerun of the results page
         xp_earned = correct * 10
-        award_xp(xp_earned, f"Test completed ({score:.0f}%)")
-        
-        if score >= 90:
-            check_achievement('test_ace')
+        if not st.session_state.get('test_xp_awarded', False):
+            st.session_state.test_xp_awarded = True
+            record_stat("tests")
+            award_xp(xp_earned, f"Test completed ({score:.0f}%)")
+            
+            if score >= 90:
+                check_achievement('test_ace')
         
         st.success(f"⭐ You earned {xp_earned} XP!")
         
-        if st.button("🔄 Take Another Test", use_container_width=True, type="primary"):
-            st.session_state.test_active = False
-            st.session_state.test_questions = []
-            st.session_state.test_answers = {}
-            st.session_state.test_submitted = False
-            st.rerun()
+        # Line up the next test while the results are being read
+        params = st.session_state.get('test_params')
+        if params:
+            start_test_prefetch(next_test_params(params, score))
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("🔄 Take Another Test", use_container_width=True, type="primary"):
+                with st.spinner("👨‍🏫 Getting your next test ready..."):
+                    prefetched = take_prefetched_test()
+                if prefetched:
+                    start_test(*prefetched)
+                else:
+                    st.session_state.test_active = False
+                    st.session_state.test_questions = []
+                    st.session_state.test_answers = {}
+                    st.session_state.test_submitted = False
+                st.rerun()
+        with col2:
+            if st.button("✏️ New Topic", use_container_width=True):
+                cancel_test_prefetch()
+                st.session_state.test_active = False
+                st.session_state.test_questions = []
+                st.session_state.test_answers = {}
+                st.session_state.test_submitted = False
+                st.rerun()
+
+IMAGE_ANALYSIS_PROMPTS = {
+    "📝 Explain everything": "Explain everything in this study material in detail.",
+    "💡 Key points only": "List key points as a numbered list.",
+    "❓ Practice questions": "Create 5 practice questions from this content.",
+    "🔍 Find formulas": "Identify and explain all formulas/equations shown.",
+    "📊 Explain diagram": "Describe this diagram/chart in detail."
+}
+
+def show_batch_image_analysis(uploaded_files):
+    """Analyze several pages concurrently, showing each result as soon as it is ready"""
+    st.write(f"**📚 {len(uploaded_files)} pages selected**")
+    
+    analysis_type = st.radio("What to analyze?", list(IMAGE_ANALYSIS_PROMPTS), key="batch_analysis_type")
+    batch_key = tuple(f.file_id for f in uploaded_files) + (analysis_type,)
+    
+    if st.button("🔍 Analyze All Pages", type="primary"):
+        limit_error = check_usage_limit(len(uploaded_files))  # One vision call per page
+        if limit_error:
+            st.error(limit_error)
+            return
+        
+        total = len(uploaded_files)
+        progress = st.progress(0.0, text=f"Analyzing 0/{total} pages...")
+        slots = [st.empty() for _ in uploaded_files]
+        for idx, uploaded in enumerate(uploaded_files):
+            slots[idx].info(f"⏳ Page {idx + 1}: {uploaded.name}")
+        
+        results = [None] * total
+        for done, (idx, processed, result, error) in enumerate(
+                analyze_image_batch(uploaded_files, IMAGE_ANALYSIS_PROMPTS[analysis_type]), 1):
+            results[idx] = {"name": uploaded_files[idx].name, "result": result, "error": error,
+                            "saved": format_bytes_saved(processed) if processed else ""}
+            with slots[idx].container():
+                show_batch_result(idx, results[idx])
+            progress.progress(done / total, text=f"Analyzing {done}/{total} pages...")
+        
+        st.session_state.batch_analysis = {"key": batch_key, "results": results}
+        
+        succeeded = sum(1 for r in results if r["result"])
+        if succeeded:
+            record_usage(succeeded)
+            award_xp(10 * succeeded, "Batch image analysis")
+    
+    elif st.session_state.get('batch_analysis', {}).get("key") == batch_key:
+        # Keep showing the last batch across reruns (e.g. after a download click)
+        for idx, item in enumerate(st.session_state.batch_analysis["results"]):
+            show_batch_result(idx, item)
+    
+    batch = st.session_state.get('batch_analysis')
+    if batch and batch["key"] == batch_key:
+        combined = "\n\n---\n\n".join(
+            f"# Page {idx + 1}: {item['name']}\n\n{item['result'] or '(analysis failed: ' + str(item['error']) + ')'}"
+            for idx, item in enumerate(batch["results"])
+        )
+        st.download_button("📥 Download All Pages", combined, "analysis_all_pages.md", mime="text/markdown")
+
+def show_multi_image_analysis(processed, analysis_types, multi_key):
+    """Run several analysis types on one image concurrently, filling a tab per type as it finishes"""
+    limit_error = check_usage_limit(len(analysis_types))
+    if limit_error:
+        st.error(limit_error)
+        return
+    
+    tabs = st.tabs(analysis_types)
+    slots = {}
+    for label, tab in zip(analysis_types, tabs):
+        with tab:
+            slots[label] = st.empty()
+            slots[label].info("⏳ Analyzing...")
+    
+    results = {}
+    prompts = {label: IMAGE_ANALYSIS_PROMPTS[label] for label in analysis_types}
+    for label, result, error in analyze_image_multi(processed, prompts):
+        results[label] = {"result": result, "error": error}
+        with slots[label].container():
+            show_multi_result(results[label])
+    
+    st.session_state.multi_analysis = {"key": multi_key, "results": results}
+    
+    succeeded = sum(1 for r in results.values() if r["result"])
+    if succeeded:
+        record_usage(succeeded)
+        award_xp(10 * succeeded, "Image analysis")
+
+def show_multi_result(item):
+    """Render one analysis type of a multi-analysis"""
+    if item["result"]:
+        st.markdown(item["result"])
+    else:
+        st.error(item["error"] or "Vision unavailable. Describe the image and I'll help!")
+
+def show_batch_result(idx, item):
+    """Render one page of a batch analysis"""
+    if item["result"]:
+        with st.expander(f"✅ Page {idx + 1}: {item['name']}"):
+            st.markdown(item["result"])
+            if item["saved"]:
+                st.caption(item["saved"])
+    else:
+        st.error(f"❌ Page {idx + 1}: {item['name']} - {item['error']}")
 
 def show_image_analysis():
     """Image analysis with AI vision"""
@@ -1216,41 +3168,74 @@ def show_image_analysis():
     tab1, tab2 = st.tabs(["📤 Upload", "📷 Camera"])
     
     with tab1:
-        uploaded = st.file_uploader("Choose image", type=['png', 'jpg', 'jpeg', 'webp'])
+        uploaded_files = st.file_uploader(
+            "Choose image(s)",
+            type=['png', 'jpg', 'jpeg', 'webp'],
+            accept_multiple_files=True,
+            help="Select several pages to analyze them all at once"
+        )
+        
+        if len(uploaded_files) > IMAGE_BATCH_MAX_FILES:
+            st.warning(f"⚠️ Only the first {IMAGE_BATCH_MAX_FILES} images will be analyzed")
+            uploaded_files = uploaded_files[:IMAGE_BATCH_MAX_FILES]
         
-        if uploaded:
-            img = Image.open(uploaded)
-            st.image(img, width=450)
+        if len(uploaded_files) > 1:
+            show_batch_image_analysis(uploaded_files)
+        elif uploaded_files:
+            uploaded = uploaded_files[0]
             
-            analysis_type = st.radio("What to analyze?", [
-                "📝 Explain everything",
-                "💡 Key points only",
-                "❓ Practice questions",
-                "🔍 Find formulas",
-                "📊 Explain diagram"
-            ])
+            # One decode feeds both the preview and the upload
+            try:
+                processed = get_preprocessed_image(uploaded)
+            except Exception as e:
+                processed = None
+                st.error(f"Couldn't read image: {e}")
             
-            if st.button("🔍 Analyze", type="primary"):
-                prompts = {
-                    "📝 Explain everything": "Explain everything in this study material in detail.",
-                    "💡 Key points only": "List key points as a numbered list.",
-                    "❓ Practice questions": "Create 5 practice questions from this content.",
-                    "🔍 Find formulas": "Identify and explain all formulas/equations shown.",
-                    "📊 Explain diagram": "Describe this diagram/chart in detail."
-                }
+            if processed:
+                st.image(processed["image"], width=450)
+                st.caption(format_bytes_saved(processed))
                 
-                with st.spinner("🧠 Analyzing..."):
-                    result, error = analyze_image_with_ai(uploaded, prompts[analysis_type])
+                analysis_types = st.multiselect(
+                    "What to analyze?",
+                    list(IMAGE_ANALYSIS_PROMPTS),
+                    default=[next(iter(IMAGE_ANALYSIS_PROMPTS))],
+                    help="Pick several to run them all at once"
+                )
                 
-                if result:
-                    st.markdown("---")
-                    st.markdown(result)
-                    st.markdown("---")
-                    
-                    st.download_button("📥 Download", result, "analysis.txt")
-                    award_xp(10, "Image analysis")
-                else:
-                    st.error(error or "Vision unavailable. Describe the image and I'll help!")
+                multi_key = (uploaded.file_id, tuple(analysis_types))
+                multi = st.session_state.get('multi_analysis')
+                
+                if st.button("🔍 Analyze", type="primary", disabled=not analysis_types):
+                    if len(analysis_types) > 1:
+                        show_multi_image_analysis(processed, analysis_types, multi_key)
+                        multi = st.session_state.get('multi_analysis')
+                    else:
+                        analysis_type = analysis_types[0]
+                        with st.spinner("🧠 Analyzing..."):
+                            result, error = analyze_image_with_ai(processed, IMAGE_ANALYSIS_PROMPTS[analysis_type])
+                        
+                        if result:
+                            st.markdown("---")
+                            st.markdown(result)
+                            st.markdown("---")
+                        
+                            st.download_button("📥 Download", result, "analysis.txt")
+                            award_xp(10, "Image analysis")
+                        else:
+                            st.error(error or "Vision unavailable. Describe the image and I'll help!")
+                
+                elif multi and multi["key"] == multi_key:
+                    # Keep showing the last multi-analysis across reruns (e.g. after a download click)
+                    for label, tab in zip(analysis_types, st.tabs(analysis_types)):
+                        with tab:
+                            show_multi_result(multi["results"][label])
+                
+                if multi and multi["key"] == multi_key and any(r["result"] for r in multi["results"].values()):
+                    combined = "\n\n---\n\n".join(
+                        f"# {label}\n\n{multi['results'][label]['result']}"
+                        for label in analysis_types if multi["results"][label]["result"]
+                    )
+                    st.download_button("📥 Download All", combined, "analysis.md", mime="text/markdown")
     
     with tab2:
         photo = st.camera_input("Take a photo")
@@ -1263,6 +3248,7 @@ def show_image_analysis():
                     result, error = analyze_image_with_ai(photo, "Explain this study material in detail.")
                 
                 if result:
+                    st.caption(format_bytes_saved(get_preprocessed_image(photo)))
                     st.markdown("---")
                     st.markdown(result)
                     award_xp(10, "Photo analysis")
@@ -1301,9 +3287,12 @@ def show_study_timer():
             # Update total study time
             try:
                 current_time = st.session_state.user_data.get('total_study_time', 0)
-                supabase.table("profiles").update({
+                db.update_profile(st.session_state.user.id, {
                     "total_study_time": current_time + study_time
-                }).eq("id", st.session_state.user.id).execute()
+                })
+                st.session_state.user_data['total_study_time'] = current_time + study_time
+                invalidate_profile_cache()
+                record_stat("study_seconds", study_time)
             except:
                 pass
             
@@ -1338,6 +3327,49 @@ def show_settings():
     
     st.markdown("---")
     
+    st.write("### ⚡ Response Cache")
+    
+    stats = response_cache_stats()
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Hits", stats["hits"])
+    with col2:
+        st.metric("Misses", stats["misses"])
+    with col3:
+        st.metric("Hit Rate", f"{stats['hit_rate']:.0%}")
+    with col4:
+        st.metric("Cached Answers", stats["entries"])
+    
+    if st.button("🧹 Clear Response Cache"):
+        if clear_response_cache():
+            st.success("Response cache cleared!")
+    
+    st.markdown("---")
+    
+    st.write("### 💾 Background Writes")
+    
+    writes = write_queue_stats(getattr(st.session_state.user, "id", None))
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Pending", writes["pending"])
+    with col2:
+        st.metric("Written", writes["written"])
+    with col3:
+        st.metric("Retries", writes["retries"])
+    with col4:
+        st.metric("Dropped", writes["dropped"])
+    
+    if writes["last_error"]:
+        st.caption(f"Last write error: {writes['last_error']}")
+    
+    if writes["pending"] and st.button("⏫ Flush Now"):
+        if flush_user_writes():
+            st.success("All writes saved!")
+        else:
+            st.warning("Some writes are still pending")
+    
+    st.markdown("---")
+    
     st.write("### ℹ️ About")
     st.info("""
 **Study Master Infinity** v2.0
@@ -1354,8 +3386,14 @@ Made with ❤️ by Aarya
     if st.button("🗑️ Delete All Data", type="secondary"):
         if st.checkbox("I understand this cannot be undone"):
             try:
-                supabase.table("history").delete().eq("user_id", st.session_state.user.id).execute()
-                supabase.table("notes").delete().eq("user_id", st.session_state.user.id).execute()
+                flush_user_writes()
+                db.delete_history(st.session_state.user.id)
+                db.delete_notes(st.session_state.user.id)
+                reset_notes_list()
+                st.session_state.note_content_cache = {}
+                invalidate_notes_index()
+                reset_stats("chat_messages", "notes")
+                invalidate_reads("recent_history")
                 st.success("All data deleted!")
             except:
                 st.error("Failed to delete data")
@@ -1388,6 +3426,8 @@ def show_schedule_planner():
             ["Visual Learner", "Auditory Learner", "Kinesthetic Learner", "Reading/Writing"]
         )
         
+        force_refresh = st.checkbox("🔄 Generate a fresh schedule (skip cache)")
+        
         submit = st.form_submit_button("🚀 Generate Schedule", use_container_width=True, type="primary")
         
         if submit and subjects:
@@ -1411,9 +3451,11 @@ Provide:
 Make it realistic, achievable, and motivating!"""
             
             with st.spinner("🎨 Creating your personalized schedule..."):
-                schedule, error = safe_ai_call(prompt, include_memory=False)
+                schedule, error, from_cache = cached_ai_call(prompt, force_refresh=force_refresh, feature="schedule")
             
             if schedule:
+                if from_cache:
+                    st.caption("⚡ Served from cache - tick 'Generate a fresh schedule' for a new one")
                 st.markdown("---")
                 st.markdown(schedule)
                 st.markdown("---")
@@ -1449,6 +3491,8 @@ def show_flashcards():
                 ["Simple Q&A", "Detailed Explanation", "Fill in Blank", "True/False"]
             )
         
+        force_refresh = st.checkbox("🔄 Generate fresh cards (skip cache)")
+        
         submit = st.form_submit_button("🎴 Generate Flashcards", use_container_width=True, type="primary")
         
         if submit and topic:
@@ -1459,26 +3503,23 @@ def show_flashcards():
                 "True/False": "Create true/false statement cards."
             }
             
-            prompt = f"""Create {num_cards} flashcards for studying {topic}.
-{style_prompts[card_style]}
-
-Format each card:
-
-**Card 1**
-Front: [Question/Term/Statement]
-Back: [Answer/Definition/Explanation]
-
-**Card 2**
-Front: [Question/Term/Statement]
-Back: [Answer/Definition/Explanation]
-
-Continue for all {num_cards} cards.
-Make them clear, educational, and test-worthy!"""
+            limit_error = check_usage_limit(len(chunk_counts(num_cards, FLASHCARD_CHUNK_SIZE)))
             
-            with st.spinner("🎨 Creating flashcards..."):
-                flashcards, error = safe_ai_call(prompt, include_memory=False)
+            if limit_error:
+                flashcards, error, from_cache = None, limit_error, False
+            else:
+                with st.spinner("🎨 Creating flashcards..."):
+                    cards, error, from_cache = generate_in_chunks(
+                        num_cards, FLASHCARD_CHUNK_SIZE,
+                        lambda count, hint, avoid: build_flashcard_prompt(topic, style_prompts[card_style], count, hint, avoid),
+                        parse_flashcards, lambda card: card["front"],
+                        feature="flashcards", force_refresh=force_refresh
+                    )
+                flashcards = render_flashcards(cards) if cards else None
             
             if flashcards:
+                if from_cache:
+                    st.caption("⚡ Served from cache - tick 'Generate fresh cards' for a new set")
                 st.markdown("---")
                 st.markdown(flashcards)
                 st.markdown("---")
@@ -1493,22 +3534,9 @@ Make them clear, educational, and test-worthy!"""
                         use_container_width=True
                     )
                 with col2:
-                    # Convert to CSV format
-                    csv_content = "Front,Back\n"
-                    lines = flashcards.split('\n')
-                    front, back = "", ""
-                    for line in lines:
-                        if line.startswith("Front:"):
-                            front = line.replace("Front:", "").strip()
-                        elif line.startswith("Back:"):
-                            back = line.replace("Back:", "").strip()
-                            if front and back:
-                                csv_content += f'"{front}","{back}"\n'
-                                front, back = "", ""
-                    
                     st.download_button(
                         "📥 Download as CSV",
-                        csv_content,
+                        flashcards_to_csv(flashcards),
                         file_name=f"flashcards_{topic.replace(' ', '_')}.csv",
                         mime="text/csv",
                         use_container_width=True
@@ -1567,7 +3595,7 @@ Notes:
 {note_content}"""
                 
                 with st.spinner("✨ AI enhancing your notes..."):
-                    enhanced, error = safe_ai_call(prompt, include_memory=False)
+                    enhanced, error = safe_ai_call(prompt, include_memory=False, feature="notes")
                 
                 if enhanced:
                     st.markdown("---")
@@ -1582,51 +3610,83 @@ Notes:
     with tab2:
         st.write("### Your Notes")
         
-        notes = load_notes()
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            search = st.text_input("🔍 Search notes", placeholder="Search titles, tags and content...")
+        with col2:
+            page_size = st.selectbox("Per page", NOTES_PAGE_SIZES, key="notes_page_size")
         
-        if notes:
-            # Search/filter
-            search = st.text_input("🔍 Search notes", placeholder="Search by title or tags...")
-            
-            filtered_notes = notes
-            if search:
+        if search:
+            # The index needs full content, but only re-loads it every NOTES_INDEX_TTL seconds
+            filtered_notes = search_notes(search) if ensure_notes_index(load_notes) else None
+            if filtered_notes is None:
+                # No FTS5 available - plain substring match
                 filtered_notes = [
-                    n for n in notes
+                    n for n in load_notes()
                     if search.lower() in n.get('title', '').lower()
                     or search.lower() in n.get('tags', '').lower()
+                    or search.lower() in n.get('content', '').lower()
                 ]
             
             st.write(f"**{len(filtered_notes)} notes found**")
             
             for note in filtered_notes:
-                with st.expander(f"📝 {note.get('title', 'Untitled')}"):
-                    st.write(note.get('content', ''))
-                    
-                    if note.get('tags'):
-                        st.caption(f"🏷️ Tags: {note['tags']}")
-                    
-                    st.caption(f"🕒 Created: {note.get('created_at', '')[:19]}")
-                    
-                    col1, col2, col3 = st.columns(3)
-                    with col1:
-                        if st.button("📥 Download", key=f"dl_{note['id']}"):
-                            st.download_button(
-                                "Download Note",
-                                note.get('content', ''),
-                                file_name=f"{note.get('title', 'note')}.txt",
-                                mime="text/plain",
-                                key=f"dlb_{note['id']}"
-                            )
-                    with col2:
-                        if st.button("✏️ Edit", key=f"edit_{note['id']}"):
-                            st.info("Edit feature coming soon!")
-                    with col3:
-                        if st.button("🗑️ Delete", key=f"del_{note['id']}"):
-                            if delete_note(note['id']):
-                                st.success("Deleted!")
-                                st.rerun()
+                show_note_entry(note)
         else:
-            st.info("📝 No notes yet. Create your first note in the 'Create Note' tab!")
+            notes_list = get_notes_list(page_size)
+            
+            if notes_list["items"]:
+                st.write(f"**Showing {len(notes_list['items'])} notes**")
+                
+                for note in notes_list["items"]:
+                    show_note_entry(note)
+                
+                if notes_list["has_more"] and st.button("⬇️ Load More", use_container_width=True):
+                    load_more_notes()
+                    st.rerun()
+            else:
+                st.info("📝 No notes yet. Create your first note in the 'Create Note' tab!")
+
+def show_note_entry(note):
+    """One note in the list - content comes with search results, otherwise it is fetched on demand"""
+    with st.expander(f"📝 {note.get('title', 'Untitled')}"):
+        if note.get('snippet'):
+            st.markdown(f"🔎 {note['snippet']}")
+            st.markdown("---")
+        
+        content = note.get('content')
+        if content is None:
+            content = st.session_state.note_content_cache.get(note['id'])
+        if content is None:
+            if st.button("📖 Show Content", key=f"open_{note['id']}"):
+                load_note_content(note['id'])
+                st.rerun()
+        else:
+            st.write(content)
+        
+        if note.get('tags'):
+            st.caption(f"🏷️ Tags: {note['tags']}")
+        
+        st.caption(f"🕒 Created: {note.get('created_at', '')[:19]}")
+        
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            if content is not None and st.button("📥 Download", key=f"dl_{note['id']}"):
+                st.download_button(
+                    "Download Note",
+                    content,
+                    file_name=f"{note.get('title', 'note')}.txt",
+                    mime="text/plain",
+                    key=f"dlb_{note['id']}"
+                )
+        with col2:
+            if st.button("✏️ Edit", key=f"edit_{note['id']}"):
+                st.info("Edit feature coming soon!")
+        with col3:
+            if st.button("🗑️ Delete", key=f"del_{note['id']}"):
+                if delete_note(note['id']):
+                    st.success("Deleted!")
+                    st.rerun()
 
 def show_dashboard():
     """Comprehensive dashboard with analytics"""
@@ -1662,28 +3722,18 @@ def show_dashboard():
     st.write("### 📈 Activity Statistics")
     
     try:
-        # Count different activities
-        hist_count = supabase.table("history").select("id", count="exact").eq(
-            "user_id", st.session_state.user.id
-        ).execute()
-        
-        notes_count = supabase.table("notes").select("id", count="exact").eq(
-            "user_id", st.session_state.user.id
-        ).execute()
-        
-        total_chats = hist_count.count if hist_count.count else 0
-        total_notes = notes_count.count if notes_count.count else 0
+        stats = load_user_stats()
         
         col1, col2, col3, col4 = st.columns(4)
         
         with col1:
-            st.metric("💬 Chat Messages", total_chats)
+            st.metric("💬 Chat Messages", stats["chat_messages"])
         with col2:
-            st.metric("📓 Notes Created", total_notes)
+            st.metric("📓 Notes Created", stats["notes"])
         with col3:
-            st.metric("🎯 Tests Taken", 0)  # Placeholder
+            st.metric("🎯 Tests Taken", stats["tests"])
         with col4:
-            st.metric("📝 Quizzes Generated", 0)  # Placeholder
+            st.metric("📝 Quizzes Generated", stats["quizzes"])
     except:
         st.info("Activity tracking unavailable")
     
@@ -1693,12 +3743,10 @@ def show_dashboard():
     st.write("### 📜 Recent Activity")
     
     try:
-        recent = supabase.table("history").select("*").eq(
-            "user_id", st.session_state.user.id
-        ).order("created_at", desc=True).limit(10).execute()
+        recent = load_recent_history()
         
-        if recent.data:
-            for activity in recent.data:
+        if recent:
+            for activity in recent:
                 role_icon = "👤" if activity['role'] == "user" else "🤖"
                 content = activity['content']
                 timestamp = activity['created_at'][:19]
@@ -1758,13 +3806,85 @@ def show_dashboard():
     st.write("### 📊 Progress Over Time")
     st.info("📈 Detailed analytics coming soon! Track your XP, study time, and test scores over time.")
 
+def is_admin_request():
+    """Hidden admin page: open the app with ?admin=<[admin] token from secrets>"""
+    supplied = st.query_params.get("admin")
+    if not supplied:
+        return False
+    try:
+        token = st.secrets.get("admin", {}).get("token")
+    except Exception:
+        token = None  # No secrets file at all
+    return bool(token) and hmac.compare_digest(str(supplied), str(token))
+
+def show_metrics_admin():
+    """Latency histograms for AI and storage calls, per feature"""
+    st.title("🛠️ Latency Metrics")
+
+    metrics = get_latency_metrics()
+    uptime = time.time() - metrics["since"]
+    st.caption(f"Collected over the last {uptime / 60:.0f} min by this server process • "
+               f"exported every {METRICS_EXPORT_INTERVAL}s to {METRICS_EXPORT_PATH}")
+
+    for kind, heading in (("ai", "### 🤖 AI Calls"), ("db", "### 💾 Storage Calls")):
+        st.write(heading)
+        rows = latency_summary(kind)
+        if not rows:
+            st.info("No calls recorded yet")
+            continue
+
+        # Per-feature rollup first, then each model / operation
+        by_feature = {}
+        for row in rows:
+            by_feature.setdefault(row["feature"], []).append(row)
+        cols = st.columns(min(len(by_feature), 4))
+        for i, (feature, feature_rows) in enumerate(sorted(by_feature.items())):
+            with cols[i % len(cols)]:
+                st.metric(f"{feature} p99", f"{max(r['p99_ms'] for r in feature_rows):.0f} ms")
+                st.caption(f"{sum(r['calls'] for r in feature_rows)} calls")
+
+        st.dataframe([{
+            "feature": row["feature"],
+            "model" if kind == "ai" else "operation": row["target"],
+            "calls": row["calls"],
+            "errors": row["errors"],
+            "p50 ms": round(row["p50_ms"], 1),
+            "p95 ms": round(row["p95_ms"], 1),
+            "p99 ms": round(row["p99_ms"], 1),
+            "max ms": round(row["max_ms"], 1),
+        } for row in rows], use_container_width=True, hide_index=True)
+
+    st.caption("Percentiles are estimated from histogram buckets; AI rows include rate-limited and failed attempts.")
+
+    col1, col2 = st.columns(2)
+    with col1:
+        st.download_button("📥 Download Prometheus Metrics", metrics_text(), "metrics.prom", mime="text/plain")
+    with col2:
+        if st.button("🧹 Reset Metrics"):
+            reset_latency_metrics()
+            st.rerun()
+
 # ==================== MAIN APP LOGIC ====================
 
 def main():
     """Main application logic"""
+    begin_rerun()
+    try:
+        route_app()
+    finally:
+        end_rerun(st.session_state.selected_menu if st.session_state.user else "login")
+
+def route_app():
+    """Show the login screen or the selected feature page"""
+    
+    if is_admin_request():
+        set_rerun_feature("admin")
+        show_metrics_admin()
+        return
     
     # Check if user is logged in (or guest)
     if not st.session_state.user:
+        set_rerun_feature("auth")
         login_screen()
         return
     
@@ -1784,19 +3904,22 @@ def main():
     else:
         # Load user profile for logged-in users
         try:
-            profile_res = supabase.table("profiles").select("*").eq("id", st.session_state.user.id).execute()
+            profile = load_profile()
             
-            if not profile_res.data:
+            if not profile:
+                set_rerun_feature("auth")
                 username_setup_screen()
                 return
             
-            st.session_state.user_data = profile_res.data[0]
+            profile['xp'] = xp_ledger_sync(st.session_state.user.id, profile.get('xp', 0))
+            st.session_state.user_data = profile
         except Exception as e:
             st.error(f"Profile error: {e}")
             st.session_state.user_data = {"username": "User", "xp": 0, "is_premium": False}
     
     # Show sidebar and get menu choice
     menu = show_sidebar()
+    set_rerun_feature(PAGE_FEATURES.get(menu, "app"))
     
     # Show guest limitation banner for certain features
     if is_guest and menu in ["📓 Study Notes", "📊 Dashboard"]:
@@ -0,0 +1,357 @@
+"""
+Concurrent-session load test: drives N simulated students through app.py with
+streamlit.testing AppTest, against local stand-ins for the external services
+(SQLite storage and replayed AI answers - no network, no credentials).
+
+    python benchmarks/load_test.py --sessions 1,5,10            # one run per concurrency level
+    python benchmarks/load_test.py --sessions 20 --chat-turns 5
+    python benchmarks/load_test.py --ai-ttft 0.4 --ai-tokens-per-second 400   # simulate model latency
+
+Each session signs up, sends chat turns, generates a Teacher Mode test, answers and
+submits it, then opens the dashboard. Reported per concurrency level:
+p50/p95/p99 latency of each interaction by page, database round trips and AI calls
+per script run, and memory per session. --output writes everything as JSON.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+CHAT_MODEL = "llama-3.3-70b-versatile"
+SUMMARY_MODEL = "llama-3.1-8b-instant"
+CHAT_PROMPTS = [
+    "Explain photosynthesis in simple terms",
+    "What is the difference between mitosis and meiosis?",
+    "Give me a mnemonic for the planets",
+    "How do I balance a chemical equation?",
+    "Summarize the causes of World War I",
+]
+SESSION_NUMBERS = itertools.count(1)  # Names are "student<n>" - unique per run, within the app's 20-character usernames
+
+
+# ==================== STAND-INS ====================
+
+def write_standin_recording(path):
+    """Replay recording with one chat answer, one Teacher Mode test (JSON mode) and one summary"""
+    answer = " ".join(["Photosynthesis turns light energy, water and carbon dioxide into glucose and oxygen."] * 8)
+    test = {"questions": [{
+        "question": f"Sample question {i}: which statement about photosynthesis is correct?",
+        "options": {"A": "It releases oxygen", "B": "It needs no light", "C": "It happens in mitochondria",
+                    "D": "It consumes glucose"},
+        "correct": "A"
+    } for i in range(1, 11)]}
+    entries = [
+        {"key": "standin-chat", "model": CHAT_MODEL, "json_mode": False, "text": answer},
+        {"key": "standin-test", "model": CHAT_MODEL, "json_mode": True, "text": json.dumps(test)},
+        {"key": "standin-summary", "model": SUMMARY_MODEL, "json_mode": False,
+         "text": "The student is revising photosynthesis and cell division."},
+    ]
+    with open(path, "w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(dict(entry, prompt="", ttft=None, tokens_per_second=None)) + "\n")
+
+
+def write_secrets(workdir, args):
+    """Point the app at the stand-ins through .streamlit/secrets.toml in the working directory"""
+    recording = os.path.join(workdir, "standin_recording.jsonl")
+    write_standin_recording(recording)
+    lines = [
+        "[storage]",
+        'backend = "sqlite"',
+        f'path = {json.dumps(os.path.join(workdir, "study.sqlite3"))}',
+        "",
+        "[ai]",
+        'provider = "replay"',
+        f"recording = {json.dumps(recording)}",
+        f"simulate_latency = {'true' if args.ai_ttft or args.ai_tokens_per_second else 'false'}",
+        f"ttft = {args.ai_ttft}",
+    ]
+    if args.ai_tokens_per_second:
+        lines.append(f"tokens_per_second = {args.ai_tokens_per_second}")
+    os.makedirs(os.path.join(workdir, ".streamlit"), exist_ok=True)
+    with open(os.path.join(workdir, ".streamlit", "secrets.toml"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+# ==================== SESSION FLOW ====================
+
+def widget(elements, label, nth=0):
+    """The nth widget with the given label (the login and signup forms share some labels)"""
+    matches = [element for element in elements if element.label == label]
+    if len(matches) <= nth:
+        raise LookupError(f"No widget labelled {label!r}")
+    return matches[nth]
+
+
+def menu(at):
+    """The sidebar navigation radio"""
+    for element in at.sidebar.radio:
+        if "🏠 Home" in element.options:
+            return element
+    raise LookupError("Sidebar menu not rendered")
+
+
+def share_test_runtime():
+    """
+    Make AppTest safe to run from several threads, the way one Streamlit server is shared.
+    AppTest installs a mock Runtime singleton per script run and clears it when the run
+    ends, which breaks runs still in flight on other threads - keep the latest mock
+    installed instead (media and cache managers are keyed per session, so sharing is safe).
+    It also compiles app.py afresh on every run; share one script cache like the server
+    does (concurrent compiles of a large file can crash the parser on Python 3.11).
+    """
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import app_test, local_script_runner
+
+    script_cache = ScriptCache()
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: script_cache
+
+    class KeepInstance(type):
+        def __setattr__(cls, name, value):
+            if name == "_instance":
+                if value is not None:
+                    Runtime._instance = value
+                return
+            super().__setattr__(name, value)
+
+    class SharedRuntime(Runtime, metaclass=KeepInstance):
+        pass
+
+    app_test.Runtime = SharedRuntime
+
+
+class Session:
+    """One simulated student; every interaction is timed and its script runs' counters recorded"""
+
+    def __init__(self, name, args, samples):
+        from streamlit.testing.v1 import AppTest
+        self.name = name
+        self.args = args
+        self.samples = samples
+        self.errors = []
+        self.at = AppTest.from_file(APP_PATH, default_timeout=args.timeout)
+
+    def totals(self):
+        try:
+            return dict(self.at.session_state["rerun_totals"])
+        except KeyError:
+            return {"runs": 0, "round_trips": 0, "ai_calls": 0}
+
+    def step(self, page, action):
+        before = self.totals()
+        started = time.perf_counter()
+        action()
+        elapsed = time.perf_counter() - started
+        after = self.totals()
+        if self.at.exception:
+            self.errors.append(f"{self.name} {page}: {self.at.exception[0].message}")
+        self.samples.append({
+            "page": page,
+            "elapsed": elapsed,
+            "runs": after["runs"] - before["runs"],
+            "round_trips": after["round_trips"] - before["round_trips"],
+            "ai_calls": after["ai_calls"] - before["ai_calls"],
+        })
+
+    def run(self):
+        at = self.at
+        self.step("login", at.run)
+
+        # Sign up (the SQLite backend logs straight in), then create the profile
+        widget(at.text_input, "📧 Email Address").input(f"{self.name}@example.com")
+        widget(at.text_input, "🔒 Password", nth=1).input("password123")
+        widget(at.text_input, "🔒 Confirm Password").input("password123")
+        widget(at.checkbox, "I agree to the Terms of Service and Privacy Policy").check()
+        self.step("login", widget(at.button, "🎉 Create Account").click().run)
+        widget(at.text_input, "👤 Username").input(self.name)
+        self.step("home", widget(at.button, "💾 Create Profile").click().run)
+
+        self.step("chat", menu(at).set_value("💬 Chat").run)
+        for turn in range(self.args.chat_turns):
+            self.step("chat", at.chat_input[0].set_value(CHAT_PROMPTS[turn % len(CHAT_PROMPTS)]).run)
+
+        self.step("teacher", menu(at).set_value("👨‍🏫 Teacher Mode").run)
+        widget(at.text_input, "📖 Subject").input("Biology")
+        widget(at.text_input, "📌 Topic").input("Photosynthesis")
+        self.step("teacher", widget(at.button, "🎯 Generate Test").click().run)
+        for answer in [r for r in at.radio if r.label == "Your answer:"]:
+            answer.set_value("A")
+        self.step("teacher", at.run)
+        self.step("teacher", widget(at.button, "📤 Submit Test").click().run)
+
+        self.step("dashboard", menu(at).set_value("📊 Dashboard").run)
+
+
+# ==================== MEASUREMENT ====================
+
+def rss_bytes():
+    """Current resident set size (Linux), falling back to the peak from getrusage"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def deep_size(obj, seen=None):
+    """Approximate memory held by an object graph"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += deep_size(vars(obj), seen)
+    return size
+
+
+def session_state_bytes(at):
+    """Size of a session's user-visible state (relies on AppTest internals, so best effort)"""
+    try:
+        return deep_size(dict(at._session_state._state.filtered_state))
+    except Exception:
+        return None
+
+
+def percentile(ordered, pct):
+    """Nearest-rank percentile of a sorted list"""
+    if not ordered:
+        return None
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def summarize_pages(samples):
+    pages = {}
+    for page in dict.fromkeys(s["page"] for s in samples):
+        rows = [s for s in samples if s["page"] == page]
+        latencies = sorted(s["elapsed"] for s in rows)
+        runs = sum(s["runs"] for s in rows) or 1
+        pages[page] = {
+            "interactions": len(rows),
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "mean": statistics.fmean(latencies),
+            "script_runs": runs,
+            "round_trips_per_run": sum(s["round_trips"] for s in rows) / runs,
+            "ai_calls_per_run": sum(s["ai_calls"] for s in rows) / runs,
+        }
+    return pages
+
+
+def run_level(level, count, args):
+    """Run `count` sessions at once and summarize them"""
+    samples = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(count)
+    rss_before = rss_bytes()
+    sessions = []
+
+    def worker(index):
+        local = []
+        session = Session(f"student{next(SESSION_NUMBERS)}", args, local)
+        barrier.wait()
+        try:
+            session.run()
+        except Exception as e:
+            session.errors.append(f"{session.name}: {type(e).__name__}: {e}")
+        with lock:
+            samples.extend(local)
+            sessions.append(session)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        list(pool.map(worker, range(count)))
+    wall = time.perf_counter() - started
+
+    # Sessions are still alive here, so RSS includes everything they hold
+    rss_after = rss_bytes()
+    state_sizes = [size for size in map(session_state_bytes, (s.at for s in sessions)) if size is not None]
+    return {
+        "sessions": count,
+        "wall_seconds": wall,
+        "interactions_per_second": len(samples) / wall if wall else None,
+        "memory_per_session_bytes": max(0, rss_after - rss_before) / count,
+        "session_state_bytes": statistics.fmean(state_sizes) if state_sizes else None,
+        "errors": [error for s in sessions for error in s.errors],
+        "pages": summarize_pages(samples),
+    }
+
+
+def print_level(result):
+    print(f"\n=== {result['sessions']} concurrent sessions - {result['wall_seconds']:.1f}s wall, "
+          f"{result['memory_per_session_bytes'] / 1e6:.1f} MB RSS/session"
+          + (f", {result['session_state_bytes'] / 1e3:.0f} KB session state" if result["session_state_bytes"] else ""))
+    print(f"{'page':12} {'n':>4} {'p50':>9} {'p95':>9} {'p99':>9} {'db/run':>7} {'ai/run':>7}")
+    for page, s in result["pages"].items():
+        print(f"{page:12} {s['interactions']:4d} {s['p50'] * 1e3:7.0f}ms {s['p95'] * 1e3:7.0f}ms "
+              f"{s['p99'] * 1e3:7.0f}ms {s['round_trips_per_run']:7.2f} {s['ai_calls_per_run']:7.2f}")
+    for error in result["errors"][:10]:
+        print(f"  ! {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", default="1,5,10", help="comma-separated concurrency levels")
+    parser.add_argument("--chat-turns", type=int, default=3)
+    parser.add_argument("--ai-ttft", type=float, default=0.0, help="simulated seconds to first token")
+    parser.add_argument("--ai-tokens-per-second", type=float, default=0.0, help="simulated generation speed")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds allowed per script run")
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    # The app reads its secrets and writes its caches relative to the working directory
+    workdir = tempfile.mkdtemp(prefix="study-load-")
+    write_secrets(workdir, args)
+    os.chdir(workdir)
+    share_test_runtime()
+
+    # One unreported session first, so imports and process-wide caches don't count as per-session memory
+    warmup = run_level("warmup", 1, args)
+    if warmup["errors"]:
+        sys.exit("Warmup session failed - measurements would include process start-up:\n  "
+                 + "\n  ".join(warmup["errors"]))
+
+    levels = [int(n) for n in args.sessions.split(",")]
+    results = []
+    for level, count in enumerate(levels):
+        result = run_level(level, count, args)
+        print_level(result)
+        results.append(result)
+
+    if args.output:
+        report = {
+            "meta": {
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "chat_turns": args.chat_turns,
+                "ai_ttft": args.ai_ttft,
+                "ai_tokens_per_second": args.ai_tokens_per_second,
+                "workdir": workdir,
+            },
+            "levels": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
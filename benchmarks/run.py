@@ -0,0 +1,248 @@
+"""
+Microbenchmarks for the app's pure hot paths (study_core - no Streamlit, no network).
+
+    python benchmarks/run.py                          # all cases, results to bench_results.json
+    python benchmarks/run.py -k teacher -k csv        # only cases whose name contains a filter
+    python benchmarks/run.py --quick                  # fewer rounds, shorter extreme chat history
+    python benchmarks/run.py --compare old.json       # print the change in median vs an earlier run
+
+Results are JSON (timings in seconds) so runs can be compared across commits.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PIL
+from PIL import Image
+
+from study_core import (
+    assemble_ai_messages, flashcards_to_csv, parse_test_questions, preprocess_image,
+    validate_email, validate_username
+)
+
+MIN_ROUNDS = 5
+MIN_TIME = 1.0  # Seconds spent timing each case (after warmup)
+QUICK_MIN_TIME = 0.2
+REGRESSION_THRESHOLD = 0.10  # Median slowdown reported as a regression by --compare
+
+rng = random.Random()  # Re-seeded per case - identical inputs on every run
+
+
+# ==================== SYNTHETIC INPUTS ====================
+
+def words(count):
+    return " ".join(rng.choice(("photosynthesis", "mitochondria", "the", "energy", "cell", "light",
+                                "reaction", "glucose", "of", "produces", "chlorophyll", "and"))
+                    for _ in range(count))
+
+
+def test_json(num_q, truncated=False, fenced=False):
+    """Model output for a Teacher Mode test in the JSON-mode shape"""
+    questions = [{
+        "question": f"Q{i}: {words(15)}?",
+        "options": {letter: words(6) for letter in "ABCD"},
+        "correct": rng.choice("ABCD")
+    } for i in range(num_q)]
+    text = json.dumps({"questions": questions}, indent=2)
+    if truncated:
+        text = text[:int(len(text) * 0.9)]  # Cut off mid-question, like a max_tokens stop
+    if fenced:
+        text = f"```json\n{text}\n```"
+    return text
+
+
+def test_legacy_text(num_q):
+    """Model output in the older QUESTION / A) / CORRECT_ANSWER format"""
+    blocks = []
+    for i in range(num_q):
+        options = "\n".join(f"{letter}) {words(6)}" for letter in "ABCD")
+        blocks.append(f"QUESTION {i + 1}:\n{words(15)}?\n{options}\nCORRECT_ANSWER: {rng.choice('ABCD')}")
+    return "\n\n".join(blocks)
+
+
+def flashcard_deck(count):
+    """A deck rendered in the Front:/Back: format shown and exported by the Flashcards page"""
+    return "\n\n".join(f"**Card {i}**\nFront: {words(10)}\nBack: {words(30)}" for i in range(1, count + 1))
+
+
+def chat_history(count, words_per_message=40):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": words(words_per_message)}
+            for i in range(count)]
+
+
+def photo(width, height):
+    """JPEG 'photo' of noise (worst case for the encoder) at maximum quality"""
+    img = Image.frombytes("RGB", (width, height), rng.randbytes(width * height * 3))
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=100, subsampling=0)
+    return buffer.getvalue()
+
+
+def emails(count):
+    samples = ["student@example.com", "first.last+tag@school.edu.in", "bad@", "no-at-sign.com",
+               "a@b.c", "x" * 64 + "@" + "y" * 60 + ".org", "user@sub.domain.co.uk", "@missing.local"]
+    return [rng.choice(samples) for _ in range(count)]
+
+
+def usernames(count):
+    samples = ["StarLearner", "ab", "Kandasamy_99", "bad name", "a" * 25, "செல்வம்", "brain-master", "x!y"]
+    return [rng.choice(samples) for _ in range(count)]
+
+
+# ==================== CASES ====================
+
+def build_cases(quick):
+    """name -> (setup, fn); setup builds inputs outside the timed region, fn(inputs) is timed"""
+    long_history = 100 if quick else 500
+
+    return {
+        "teacher_parser.json_10q": (lambda: test_json(10), parse_test_questions),
+        "teacher_parser.json_50q": (lambda: test_json(50), parse_test_questions),
+        "teacher_parser.json_50q_fenced": (lambda: test_json(50, fenced=True), parse_test_questions),
+        "teacher_parser.json_50q_truncated": (lambda: test_json(50, truncated=True), parse_test_questions),
+        "teacher_parser.legacy_text_50q": (lambda: test_legacy_text(50), parse_test_questions),
+
+        "flashcards_csv.30_cards": (lambda: flashcard_deck(30), flashcards_to_csv),
+        "flashcards_csv.500_cards": (lambda: flashcard_deck(500), flashcards_to_csv),
+
+        "build_messages.no_memory": (
+            lambda: words(50),
+            lambda prompt: assemble_ai_messages(prompt)),
+        "build_messages.20_messages": (
+            lambda: (words(50), chat_history(20)),
+            lambda args: assemble_ai_messages(args[0], history=args[1])),
+        f"build_messages.{long_history}_messages": (
+            lambda: (words(50), chat_history(long_history)),
+            lambda args: assemble_ai_messages(args[0], history=args[1])),
+        f"build_messages.{long_history}_messages_summarized": (
+            lambda: (words(50), chat_history(long_history), words(200)),
+            lambda args: assemble_ai_messages(args[0], history=args[1], summary=args[2],
+                                              summarized_upto=len(args[1]) - 10)),
+
+        "image_encode.phone_photo": (lambda: photo(1200, 900), lambda data: preprocess_image(io.BytesIO(data))),
+        "image_encode.20mb_photo": (lambda: photo(2500, 2000), lambda data: preprocess_image(io.BytesIO(data))),
+
+        "validate.email_x1000": (lambda: emails(1000), lambda items: [validate_email(e) for e in items]),
+        "validate.email_long": (lambda: "a" * 5000 + "@" + "b." * 2000, validate_email),
+        "validate.username_x1000": (lambda: usernames(1000), lambda items: [validate_username(u) for u in items]),
+    }
+
+
+# ==================== RUNNER ====================
+
+def time_case(fn, inputs, min_time):
+    """Per-call timings: one warmup call, then at least MIN_ROUNDS calls and min_time seconds"""
+    fn(inputs)
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < MIN_ROUNDS or time.perf_counter() - started < min_time:
+        t0 = time.perf_counter()
+        fn(inputs)
+        timings.append(time.perf_counter() - t0)
+    return timings
+
+
+def summarize(timings, input_bytes):
+    ordered = sorted(timings)
+    return {
+        "rounds": len(ordered),
+        "min": ordered[0],
+        "median": statistics.median(ordered),
+        "mean": statistics.fmean(ordered),
+        "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "stdev": statistics.stdev(ordered) if len(ordered) > 1 else 0.0,
+        "ops_per_second": 1 / statistics.median(ordered),
+        "input_bytes": input_bytes,
+    }
+
+
+def input_size(inputs):
+    if isinstance(inputs, (bytes, str)):
+        return len(inputs)
+    if isinstance(inputs, (list, tuple)):
+        return sum(input_size(item) for item in inputs)
+    if isinstance(inputs, dict):
+        return sum(input_size(value) for value in inputs.values())
+    return 0
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Print median change per case vs an earlier results file; returns the names that regressed"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    regressions = []
+    print(f"\n{'case':45} {'before':>10} {'after':>10} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]["median"], result["median"]
+        change = (after - before) / before if before else 0.0
+        flag = ""
+        if change > REGRESSION_THRESHOLD:
+            flag = "  <-- slower"
+            regressions.append(name)
+        print(f"{name:45} {before * 1e3:9.3f}ms {after * 1e3:9.3f}ms {change:+7.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", dest="filters", action="append", default=[], help="run cases containing this text")
+    parser.add_argument("--quick", action="store_true", help="fewer rounds and a shorter extreme chat history")
+    parser.add_argument("--output", default="bench_results.json", help="where to write the JSON results")
+    parser.add_argument("--compare", help="earlier results file to compare medians against")
+    parser.add_argument("--fail-on-regression", action="store_true",
+                        help=f"exit 1 if any median is more than {REGRESSION_THRESHOLD:.0%} slower than --compare")
+    args = parser.parse_args()
+
+    min_time = QUICK_MIN_TIME if args.quick else MIN_TIME
+    results = {}
+    for name, (setup, fn) in build_cases(args.quick).items():
+        if args.filters and not any(f in name for f in args.filters):
+            continue
+        rng.seed(name)  # Same inputs whichever cases are selected
+        inputs = setup()
+        results[name] = summarize(time_case(fn, inputs, min_time), input_size(inputs))
+        r = results[name]
+        print(f"{name:45} median {r['median'] * 1e3:9.3f}ms  p95 {r['p95'] * 1e3:9.3f}ms  ({r['rounds']} rounds)")
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pillow": PIL.__version__,
+            "quick": args.quick,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nWrote {len(results)} results to {args.output}")
+
+    if args.compare:
+        regressions = compare(results, args.compare)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,558 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+
+# Storage backends for profiles, chat history, notes and the user_stats rollup.
+# app.py only talks to a Repository, so the same code runs against Supabase in
+# production or a local SQLite file (single-box deployments, offline profiling).
+# Every public method is exactly one round trip to the backend.
+#
+# Counters are incremented in the database (never read-modify-write from app state),
+# so several server processes can't overwrite each other. On Supabase that needs
+# this function (run once in the SQL editor):
+#
+#   create or replace function increment_xp(p_user_id uuid, p_amount integer)
+#   returns integer language sql as $$
+#     update profiles set xp = coalesce(xp, 0) + p_amount where id = p_user_id returning xp;
+#   $$;
+#
+#   create or replace function increment_user_stats(p_user_id uuid, p_chat_messages integer,
+#       p_notes integer, p_tests integer, p_quizzes integer, p_study_seconds bigint)
+#   returns setof user_stats language sql as $$
+#     insert into user_stats as s (user_id, chat_messages, notes, tests, quizzes, study_seconds, updated_at)
+#     values (p_user_id, p_chat_messages, p_notes, p_tests, p_quizzes, p_study_seconds, now())
+#     on conflict (user_id) do update set
+#       chat_messages = s.chat_messages + excluded.chat_messages, notes = s.notes + excluded.notes,
+#       tests = s.tests + excluded.tests, quizzes = s.quizzes + excluded.quizzes,
+#       study_seconds = s.study_seconds + excluded.study_seconds, updated_at = now()
+#     returning *;
+#   $$;
+#
+# Without increment_xp, XP falls back to a compare-and-set update of profiles.xp
+# (still safe across processes, but one extra round trip per write).
+
+HISTORY_COLUMNS = ("id", "user_id", "role", "content", "created_at")
+NOTE_COLUMNS = ("id", "user_id", "title", "content", "tags", "created_at")
+PROFILE_COLUMNS = ("id", "username", "avatar", "bio", "xp", "is_premium",
+                   "study_streak", "total_study_time", "created_at")
+USER_STATS_COLUMNS = ("user_id", "chat_messages", "notes", "tests", "quizzes",
+                      "study_seconds", "updated_at")
+XP_CAS_ATTEMPTS = 5  # Re-reads allowed when another process changes XP between read and update
+
+logger = logging.getLogger("study_ai")
+
+
+def _run(run, name):
+    """Default execute hook - just perform the call"""
+    return run()
+
+
+def _is_missing_function(e, name):
+    """A Supabase RPC failed because the Postgres function hasn't been created"""
+    text = str(e).lower()
+    return name in text and any(marker in text for marker in ("pgrst202", "could not find", "does not exist"))
+
+
+class Repository:
+    """Data access interface shared by the Supabase and SQLite backends"""
+
+    backend = None
+
+    def __init__(self, execute=None):
+        # execute(run, name) wraps every round trip - used for counting and timing
+        self.execute = execute or _run
+
+    # Auth
+    def sign_in(self, email, password):
+        """Return the signed-in user (has .id and .email)"""
+        raise NotImplementedError
+
+    def sign_up(self, email, password):
+        """Create an account; returns the user, or None if it needs confirming first"""
+        raise NotImplementedError
+
+    def sign_out(self):
+        raise NotImplementedError
+
+    # Profiles
+    def get_profile(self, user_id, columns="*"):
+        """Profile row by id, or None"""
+        raise NotImplementedError
+
+    def find_profile(self, username, columns="id"):
+        """Profile row by username, or None"""
+        raise NotImplementedError
+
+    def insert_profile(self, row):
+        raise NotImplementedError
+
+    def update_profile(self, user_id, fields):
+        raise NotImplementedError
+
+    def increment_xp(self, user_id, amount):
+        """Atomically add amount to a profile's XP; returns the new total (None if there is no profile)"""
+        raise NotImplementedError
+
+    # History
+    def insert_history(self, rows):
+        """Bulk insert chat history rows"""
+        raise NotImplementedError
+
+    def history_page(self, user_id, before=None, limit=None, columns="*"):
+        """
+        History rows newest first, ordered by (created_at, id).
+        before is a row with created_at/id - only strictly older rows are returned (keyset paging).
+        """
+        raise NotImplementedError
+
+    def history_since(self, user_id, since, columns="created_at"):
+        """History rows with created_at >= since"""
+        raise NotImplementedError
+
+    def count_history(self, user_id):
+        """Exact number of history rows for a user"""
+        raise NotImplementedError
+
+    def delete_history(self, user_id):
+        raise NotImplementedError
+
+    # Notes
+    def insert_note(self, row):
+        """Insert a note and return the stored rows (with id and created_at)"""
+        raise NotImplementedError
+
+    def notes_page(self, user_id, before=None, limit=None, columns="*"):
+        """Notes newest first - same ordering and keyset rules as history_page"""
+        raise NotImplementedError
+
+    def get_note(self, note_id, columns="*"):
+        """Note row by id, or None"""
+        raise NotImplementedError
+
+    def count_notes(self, user_id):
+        """Exact number of notes for a user"""
+        raise NotImplementedError
+
+    def delete_note(self, note_id):
+        raise NotImplementedError
+
+    def delete_notes(self, user_id):
+        raise NotImplementedError
+
+    # Stats rollup
+    def get_user_stats(self, user_id):
+        """user_stats row, or None"""
+        raise NotImplementedError
+
+    def create_user_stats(self, row):
+        """Insert a stats row unless the user already has one (an existing row is left untouched)"""
+        raise NotImplementedError
+
+    def increment_user_stats(self, user_id, deltas):
+        """Atomically add deltas (field -> amount) to a user's stats row, creating it if needed; returns the row"""
+        raise NotImplementedError
+
+
+# ==================== SUPABASE ====================
+
+class SupabaseRepository(Repository):
+    """Repository backed by a supabase-py client"""
+
+    backend = "supabase"
+
+    def __init__(self, client, execute=None):
+        super().__init__(execute)
+        self.client = client
+        self.xp_function_missing = False
+
+    def _data(self, query, name):
+        return self.execute(query.execute, name).data or []
+
+    def _first(self, query, name):
+        rows = self._data(query.limit(1), name)
+        return rows[0] if rows else None
+
+    def _count(self, table, user_id, name):
+        query = self.client.table(table).select("id", count="exact").eq("user_id", user_id)
+        return self.execute(query.execute, name).count or 0
+
+    def _page(self, table, user_id, before, limit, columns, name):
+        query = self.client.table(table).select(columns).eq("user_id", user_id)
+        if before:
+            created_at, row_id = before["created_at"], before["id"]
+            query = query.or_(
+                f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt."{row_id}")'
+            )
+        query = query.order("created_at", desc=True).order("id", desc=True)
+        if limit is not None:
+            query = query.limit(limit)
+        return self._data(query, name)
+
+    def sign_in(self, email, password):
+        return self.execute(lambda: self.client.auth.sign_in_with_password({
+            "email": email,
+            "password": password
+        }), "auth.sign_in").user
+
+    def sign_up(self, email, password):
+        return self.execute(lambda: self.client.auth.sign_up({
+            "email": email,
+            "password": password
+        }), "auth.sign_up").user
+
+    def sign_out(self):
+        self.execute(self.client.auth.sign_out, "auth.sign_out")
+
+    def get_profile(self, user_id, columns="*"):
+        return self._first(self.client.table("profiles").select(columns).eq("id", user_id), "profiles.get")
+
+    def find_profile(self, username, columns="id"):
+        return self._first(self.client.table("profiles").select(columns).eq("username", username), "profiles.find")
+
+    def insert_profile(self, row):
+        self._data(self.client.table("profiles").insert(row), "profiles.insert")
+
+    def update_profile(self, user_id, fields):
+        self._data(self.client.table("profiles").update(fields).eq("id", user_id), "profiles.update")
+
+    def increment_xp(self, user_id, amount):
+        if not self.xp_function_missing:
+            query = self.client.rpc("increment_xp", {"p_user_id": user_id, "p_amount": amount})
+            try:
+                return self.execute(query.execute, "profiles.increment_xp").data
+            except Exception as e:
+                if not _is_missing_function(e, "increment_xp"):
+                    raise
+                self.xp_function_missing = True
+                logger.warning("increment_xp function missing - create it (see storage.py); "
+                               "using compare-and-set XP updates meanwhile: %s", e)
+        return self._compare_and_set_xp(user_id, amount)
+
+    def _compare_and_set_xp(self, user_id, amount):
+        """Add to XP with an update that only applies if XP is still the value just read"""
+        for _ in range(XP_CAS_ATTEMPTS):
+            profile = self.get_profile(user_id, "xp")
+            if not profile:
+                return None
+            current = profile.get("xp")
+            query = self.client.table("profiles").update({"xp": (current or 0) + amount}).eq("id", user_id)
+            query = query.is_("xp", "null") if current is None else query.eq("xp", current)
+            if self._data(query, "profiles.xp_cas"):
+                return (current or 0) + amount
+        raise RuntimeError(f"XP for {user_id} kept changing - gave up after {XP_CAS_ATTEMPTS} attempts")
+
+    def insert_history(self, rows):
+        self._data(self.client.table("history").insert(rows), "history.insert")
+
+    def history_page(self, user_id, before=None, limit=None, columns="*"):
+        return self._page("history", user_id, before, limit, columns, "history.page")
+
+    def history_since(self, user_id, since, columns="created_at"):
+        return self._data(self.client.table("history").select(columns).eq(
+            "user_id", user_id
+        ).gte("created_at", since), "history.since")
+
+    def count_history(self, user_id):
+        return self._count("history", user_id, "history.count")
+
+    def delete_history(self, user_id):
+        self._data(self.client.table("history").delete().eq("user_id", user_id), "history.delete")
+
+    def insert_note(self, row):
+        return self._data(self.client.table("notes").insert(row), "notes.insert")
+
+    def notes_page(self, user_id, before=None, limit=None, columns="*"):
+        return self._page("notes", user_id, before, limit, columns, "notes.page")
+
+    def get_note(self, note_id, columns="*"):
+        return self._first(self.client.table("notes").select(columns).eq("id", note_id), "notes.get")
+
+    def count_notes(self, user_id):
+        return self._count("notes", user_id, "notes.count")
+
+    def delete_note(self, note_id):
+        self._data(self.client.table("notes").delete().eq("id", note_id), "notes.delete")
+
+    def delete_notes(self, user_id):
+        self._data(self.client.table("notes").delete().eq("user_id", user_id), "notes.delete_all")
+
+    def get_user_stats(self, user_id):
+        return self._first(self.client.table("user_stats").select("*").eq("user_id", user_id), "user_stats.get")
+
+    def create_user_stats(self, row):
+        self._data(self.client.table("user_stats").upsert(row, ignore_duplicates=True), "user_stats.create")
+
+    def increment_user_stats(self, user_id, deltas):
+        params = {"p_user_id": user_id}
+        params.update({f"p_{field}": deltas.get(field, 0) for field in USER_STATS_COLUMNS[1:-1]})
+        rows = self._data(self.client.rpc("increment_user_stats", params), "user_stats.increment")
+        return rows[0] if rows else None
+
+
+# ==================== SQLITE ====================
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    email TEXT NOT NULL UNIQUE,
+    password_hash TEXT NOT NULL,
+    salt TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS profiles (
+    id TEXT PRIMARY KEY,
+    username TEXT UNIQUE,
+    avatar TEXT,
+    bio TEXT,
+    xp INTEGER NOT NULL DEFAULT 0,
+    is_premium INTEGER NOT NULL DEFAULT 0,
+    study_streak INTEGER NOT NULL DEFAULT 0,
+    total_study_time INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT
+);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    role TEXT,
+    content TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_user_created ON history (user_id, created_at, id);
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    title TEXT,
+    content TEXT,
+    tags TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS notes_user_created ON notes (user_id, created_at, id);
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id TEXT PRIMARY KEY,
+    chat_messages INTEGER NOT NULL DEFAULT 0,
+    notes INTEGER NOT NULL DEFAULT 0,
+    tests INTEGER NOT NULL DEFAULT 0,
+    quizzes INTEGER NOT NULL DEFAULT 0,
+    study_seconds INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT
+);
+"""
+
+TABLE_COLUMNS = {
+    "profiles": PROFILE_COLUMNS,
+    "history": HISTORY_COLUMNS,
+    "notes": NOTE_COLUMNS,
+    "user_stats": USER_STATS_COLUMNS,
+}
+BOOL_COLUMNS = {"is_premium"}
+PASSWORD_ITERATIONS = 200_000
+
+
+def _timestamp(value=None):
+    """Normalize a timestamp to fixed-width ISO format so text ordering matches time ordering"""
+    moment = datetime.fromisoformat(value) if value else datetime.now()
+    return moment.isoformat(timespec="microseconds")
+
+
+def _hash_password(password, salt):
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), PASSWORD_ITERATIONS).hex()
+
+
+class LocalUser:
+    """Signed-in user for the SQLite backend - mirrors the fields app.py reads from a Supabase user"""
+
+    def __init__(self, id, email, created_at):
+        self.id = id
+        self.email = email
+        self.created_at = created_at
+        self.email_confirmed_at = created_at  # No email confirmation step locally
+
+
+class SQLiteRepository(Repository):
+    """Repository backed by one SQLite file, with the same filters, ordering and counts as Supabase"""
+
+    backend = "sqlite"
+
+    def __init__(self, path=":memory:", execute=None):
+        super().__init__(execute)
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(SQLITE_SCHEMA)
+
+    def _columns(self, table, columns):
+        """Translate a PostgREST-style column list into SQL, rejecting unknown names"""
+        if columns.strip() == "*":
+            return "*"
+        names = [c.strip() for c in columns.split(",")]
+        unknown = [n for n in names if n not in TABLE_COLUMNS[table]]
+        if unknown:
+            raise ValueError(f"Unknown column(s) for {table}: {', '.join(unknown)}")
+        return ", ".join(names)
+
+    def _row(self, row):
+        data = dict(row)
+        for column in BOOL_COLUMNS & data.keys():
+            data[column] = bool(data[column])
+        return data
+
+    def _select(self, sql, params, name):
+        def run():
+            with self.lock:
+                return [self._row(r) for r in self.conn.execute(sql, params).fetchall()]
+        return self.execute(run, name)
+
+    def _write(self, sql, params, name, many=False):
+        def run():
+            with self.lock, self.conn:
+                cursor = self.conn.executemany(sql, params) if many else self.conn.execute(sql, params)
+                return cursor.lastrowid
+        return self.execute(run, name)
+
+    def _first(self, table, columns, where, params, name):
+        rows = self._select(
+            f"SELECT {self._columns(table, columns)} FROM {table} WHERE {where} LIMIT 1", params, name
+        )
+        return rows[0] if rows else None
+
+    def _insert(self, table, row, name):
+        row = {k: v for k, v in row.items() if k != "id" or table == "profiles"}
+        columns = self._columns(table, ", ".join(row))
+        placeholders = ", ".join("?" for _ in row)
+        return self._write(f"INSERT INTO {table} ({columns}) VALUES ({placeholders})", tuple(row.values()), name)
+
+    def _count(self, table, user_id, name):
+        return self._select(f"SELECT COUNT(*) AS n FROM {table} WHERE user_id = ?", (user_id,), name)[0]["n"]
+
+    def _page(self, table, user_id, before, limit, columns, name):
+        sql = f"SELECT {self._columns(table, columns)} FROM {table} WHERE user_id = ?"
+        params = [user_id]
+        if before:
+            created_at = _timestamp(before["created_at"])
+            sql += " AND (created_at < ? OR (created_at = ? AND id < ?))"
+            params += [created_at, created_at, before["id"]]
+        sql += " ORDER BY created_at DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self._select(sql, tuple(params), name)
+
+    def sign_in(self, email, password):
+        rows = self._select("SELECT * FROM users WHERE email = ?", (email.lower(),), "auth.sign_in")
+        if not rows or _hash_password(password, rows[0]["salt"]) != rows[0]["password_hash"]:
+            raise ValueError("Invalid login credentials")
+        return LocalUser(rows[0]["id"], rows[0]["email"], rows[0]["created_at"])
+
+    def sign_up(self, email, password):
+        user = LocalUser(str(uuid.uuid4()), email.lower(), _timestamp())
+        salt = os.urandom(16).hex()
+        try:
+            self._write("INSERT INTO users (id, email, password_hash, salt, created_at) VALUES (?, ?, ?, ?, ?)",
+                        (user.id, user.email, _hash_password(password, salt), salt, user.created_at), "auth.sign_up")
+        except sqlite3.IntegrityError:
+            raise ValueError("User already registered")
+        return user
+
+    def sign_out(self):
+        pass  # No server-side session to end
+
+    def get_profile(self, user_id, columns="*"):
+        return self._first("profiles", columns, "id = ?", (user_id,), "profiles.get")
+
+    def find_profile(self, username, columns="id"):
+        return self._first("profiles", columns, "username = ?", (username,), "profiles.find")
+
+    def insert_profile(self, row):
+        row = dict(row)
+        if row.get("created_at"):
+            row["created_at"] = _timestamp(row["created_at"])
+        self._insert("profiles", row, "profiles.insert")
+
+    def update_profile(self, user_id, fields):
+        assignments = ", ".join(f"{column} = ?" for column in self._columns("profiles", ", ".join(fields)).split(", "))
+        self._write(f"UPDATE profiles SET {assignments} WHERE id = ?", (*fields.values(), user_id), "profiles.update")
+
+    def increment_xp(self, user_id, amount):
+        def run():
+            with self.lock, self.conn:
+                row = self.conn.execute("UPDATE profiles SET xp = xp + ? WHERE id = ? RETURNING xp",
+                                        (amount, user_id)).fetchone()
+                return row["xp"] if row else None
+        return self.execute(run, "profiles.increment_xp")
+
+    def insert_history(self, rows):
+        self._write(
+            "INSERT INTO history (user_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+            [(r["user_id"], r.get("role"), r.get("content"), _timestamp(r.get("created_at"))) for r in rows],
+            "history.insert", many=True
+        )
+
+    def history_page(self, user_id, before=None, limit=None, columns="*"):
+        return self._page("history", user_id, before, limit, columns, "history.page")
+
+    def history_since(self, user_id, since, columns="created_at"):
+        return self._select(
+            f"SELECT {self._columns('history', columns)} FROM history WHERE user_id = ? AND created_at >= ?",
+            (user_id, _timestamp(since)), "history.since"
+        )
+
+    def count_history(self, user_id):
+        return self._count("history", user_id, "history.count")
+
+    def delete_history(self, user_id):
+        self._write("DELETE FROM history WHERE user_id = ?", (user_id,), "history.delete")
+
+    def insert_note(self, row):
+        row = dict(row, created_at=_timestamp(row.get("created_at")))
+        note_id = self._insert("notes", row, "notes.insert")
+        return [dict(row, id=note_id)]
+
+    def notes_page(self, user_id, before=None, limit=None, columns="*"):
+        return self._page("notes", user_id, before, limit, columns, "notes.page")
+
+    def get_note(self, note_id, columns="*"):
+        return self._first("notes", columns, "id = ?", (note_id,), "notes.get")
+
+    def count_notes(self, user_id):
+        return self._count("notes", user_id, "notes.count")
+
+    def delete_note(self, note_id):
+        self._write("DELETE FROM notes WHERE id = ?", (note_id,), "notes.delete")
+
+    def delete_notes(self, user_id):
+        self._write("DELETE FROM notes WHERE user_id = ?", (user_id,), "notes.delete_all")
+
+    def get_user_stats(self, user_id):
+        return self._first("user_stats", "*", "user_id = ?", (user_id,), "user_stats.get")
+
+    def create_user_stats(self, row):
+        columns = self._columns("user_stats", ", ".join(row))
+        placeholders = ", ".join("?" for _ in row)
+        self._write(
+            f"INSERT INTO user_stats ({columns}) VALUES ({placeholders}) ON CONFLICT(user_id) DO NOTHING",
+            tuple(row.values()), "user_stats.create"
+        )
+
+    def increment_user_stats(self, user_id, deltas):
+        fields = USER_STATS_COLUMNS[1:-1]
+        updates = ", ".join(f"{f} = {f} + excluded.{f}" for f in fields)
+
+        def run():
+            with self.lock, self.conn:
+                row = self.conn.execute(
+                    f"INSERT INTO user_stats (user_id, {', '.join(fields)}, updated_at) "
+                    f"VALUES (?, {', '.join('?' for _ in fields)}, ?) "
+                    f"ON CONFLICT(user_id) DO UPDATE SET {updates}, updated_at = excluded.updated_at RETURNING *",
+                    (user_id, *(deltas.get(f, 0) for f in fields), _timestamp())
+                ).fetchone()
+                return self._row(row) if row else None
+        return self.execute(run, "user_stats.increment")
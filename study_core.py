@@ -0,0 +1,218 @@
+import base64
+import io
+import json
+import re
+from PIL import Image, ImageOps
+
+# Pure helpers used by app.py - no Streamlit, no network - so they can be
+# imported and benchmarked on their own (see benchmarks/run.py).
+
+# ==================== VALIDATION ====================
+
+def validate_email(email):
+    """Validate email format"""
+    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
+    return re.match(pattern, email) is not None
+
+def validate_username(username):
+    """Validate username format"""
+    return bool(re.match(r'^[\w\-]{3,20}$', username, re.UNICODE))
+
+# ==================== CHAT MEMORY ====================
+
+MEMORY_TOKEN_BUDGET = 1500  # Prompt tokens allowed for verbatim conversation memory
+MESSAGE_TOKEN_OVERHEAD = 4  # Role and separator tokens per chat message
+
+def estimate_tokens(text):
+    """Rough token estimate (~4 characters per token)"""
+    return max(1, len(text) // 4)
+
+def memory_window_start(history, budget=MEMORY_TOKEN_BUDGET, floor=0):
+    """Index of the oldest message (>= floor) that still fits the budget when walking back from the newest"""
+    used = 0
+    for idx in range(len(history) - 1, floor - 1, -1):
+        used += estimate_tokens(history[idx]["content"]) + MESSAGE_TOKEN_OVERHEAD
+        if used > budget:
+            return idx + 1
+    return floor
+
+def assemble_ai_messages(prompt, system_role="Expert Study Assistant", history=(), summary="", summarized_upto=0):
+    """
+    Message list sent to the model: system (+ rolling summary of the first summarized_upto turns),
+    the most recent turns of history that fit MEMORY_TOKEN_BUDGET, then the prompt
+    """
+    messages = []
+    system_content = f"{system_role}. Be helpful, clear, and educational."
+    
+    # Memory: rolling summary of older turns + recent turns verbatim within budget
+    if history:
+        if summarized_upto and summary:
+            system_content += f"\n\nSummary of the earlier conversation:\n{summary}"
+        
+        for msg in history[memory_window_start(history, floor=summarized_upto):]:
+            messages.append({
+                "role": msg["role"],
+                "content": msg["content"]
+            })
+    
+    # System message
+    messages.insert(0, {
+        "role": "system",
+        "content": system_content
+    })
+    
+    # Current prompt
+    messages.append({
+        "role": "user",
+        "content": prompt
+    })
+    
+    return messages
+
+# ==================== IMAGES ====================
+
+VISION_MAX_DIMENSION = 1600  # Longest side sent to the vision model - more detail isn't used
+VISION_IMAGE_FORMAT = "JPEG"  # "WEBP" is smaller still where the vision endpoint accepts it
+VISION_IMAGE_QUALITY = 85
+
+def preprocess_image(image_file):
+    """
+    Decode an upload once, fix EXIF orientation, downscale and re-encode it for the vision model.
+    The returned dict is shared by the preview and the upload.
+    """
+    original = image_file.getvalue() if hasattr(image_file, "getvalue") else image_file.read()
+    img = Image.open(io.BytesIO(original))
+    
+    # JPEG can decode straight at a reduced scale, which is much faster for phone photos
+    img.draft("RGB", (VISION_MAX_DIMENSION, VISION_MAX_DIMENSION))
+    img = ImageOps.exif_transpose(img)
+    
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    img.thumbnail((VISION_MAX_DIMENSION, VISION_MAX_DIMENSION), Image.Resampling.LANCZOS)
+    
+    buffer = io.BytesIO()
+    if VISION_IMAGE_FORMAT == "WEBP":
+        img.save(buffer, format="WEBP", quality=VISION_IMAGE_QUALITY, method=4)
+    else:
+        img.save(buffer, format="JPEG", quality=VISION_IMAGE_QUALITY, optimize=True)
+    encoded = buffer.getvalue()
+    
+    return {
+        "image": img,
+        "b64": base64.b64encode(encoded).decode("utf-8"),
+        "mime": f"image/{VISION_IMAGE_FORMAT.lower()}",
+        "original_bytes": len(original),
+        "encoded_bytes": len(encoded),
+    }
+
+# ==================== TEST PARSING ====================
+
+TEST_OPTION_LETTERS = ("A", "B", "C", "D")
+
+def validate_test_question(raw):
+    """Normalize one question to {'question', 'options', 'correct'}, or None if it doesn't fit the schema"""
+    if not isinstance(raw, dict):
+        return None
+    
+    question = raw.get("question")
+    options = raw.get("options")
+    if isinstance(options, list) and len(options) == len(TEST_OPTION_LETTERS):
+        options = dict(zip(TEST_OPTION_LETTERS, options))
+    if not isinstance(question, str) or not question.strip() or not isinstance(options, dict):
+        return None
+    
+    options = {str(k).strip().upper()[:1]: str(v).strip() for k, v in options.items()}
+    if set(options) != set(TEST_OPTION_LETTERS) or not all(options.values()):
+        return None
+    
+    correct = str(raw.get("correct") or "").strip().upper()[:1]
+    if correct not in options:
+        return None
+    
+    return {
+        "question": question.strip(),
+        "options": {letter: options[letter] for letter in TEST_OPTION_LETTERS},
+        "correct": correct
+    }
+
+def extract_json_items(text, key):
+    """
+    Pull the raw objects of a {key: [...]} (or bare [...]) answer out of model output,
+    repairing fenced or truncated JSON
+    """
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text.strip())
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict):
+            data = data.get(key, [])
+        if isinstance(data, list):
+            return data
+    except ValueError:
+        pass
+    
+    # Repair: decode complete objects one at a time and drop the broken tail (e.g. a max_tokens cut-off)
+    decoder = json.JSONDecoder()
+    items = []
+    idx = text.find("{", text.find("[") + 1)
+    while idx != -1:
+        try:
+            obj, end = decoder.raw_decode(text, idx)
+        except ValueError:
+            break
+        items.append(obj)
+        idx = text.find("{", end)
+    return items
+
+def extract_test_json(text):
+    """Pull raw question objects out of model output, repairing fenced or truncated JSON"""
+    return extract_json_items(text, "questions")
+
+def parse_test_text(text):
+    """Legacy line parser for the QUESTION / A) / CORRECT_ANSWER text format"""
+    questions = []
+    current_q = {}
+    
+    for line in text.split('\n'):
+        line = line.strip()
+        
+        if line.startswith('QUESTION'):
+            if current_q and 'question' in current_q:
+                questions.append(current_q)
+            current_q = {'options': {}}
+        elif line and not line.startswith(('A)', 'B)', 'C)', 'D)', 'CORRECT_ANSWER')):
+            if 'question' not in current_q and len(line) > 5:
+                current_q['question'] = line
+        elif line.startswith(('A)', 'B)', 'C)', 'D)')):
+            current_q.setdefault('options', {})[line[0]] = line[2:].strip()
+        elif 'CORRECT_ANSWER' in line and ':' in line:
+            current_q['correct'] = line.split(':', 1)[1].strip()
+    
+    if current_q and 'question' in current_q:
+        questions.append(current_q)
+    
+    return questions
+
+def parse_test_questions(text):
+    """Validated questions from JSON output, falling back to the legacy text format"""
+    questions = [q for q in map(validate_test_question, extract_test_json(text)) if q]
+    if not questions:
+        questions = [q for q in map(validate_test_question, parse_test_text(text)) if q]
+    return questions
+
+# ==================== FLASHCARDS ====================
+
+def flashcards_to_csv(flashcards):
+    """Front,Back CSV export of a deck rendered in the Front:/Back: format"""
+    csv_content = "Front,Back\n"
+    lines = flashcards.split('\n')
+    front, back = "", ""
+    for line in lines:
+        if line.startswith("Front:"):
+            front = line.replace("Front:", "").strip()
+        elif line.startswith("Back:"):
+            back = line.replace("Back:", "").strip()
+            if front and back:
+                csv_content += f'"{front}","{back}"\n'
+                front, back = "", ""
+    return csv_content